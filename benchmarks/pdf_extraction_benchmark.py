@@ -0,0 +1,82 @@
+'''
+pages/sec of the process-pool pdf extraction used by ingestion (iter_file_content) for 1, 2, 4 and N workers on a generated pdf
+
+usage (from the repo root):
+    python -m benchmarks.pdf_extraction_benchmark --pages 1000
+'''
+import os
+import asyncio
+import argparse
+import tempfile
+import multiprocessing
+from time import perf_counter
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from utils.file_content_extractor import iter_file_content, pdf_page_count
+
+
+def build_pdf(file_path: Path, num_pages: int, lines_per_page: int = 45):
+    '''write a plain text pdf with no third party dependency'''
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None, ##pages tree, filled once the page object numbers are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_object_numbers = []
+    for page_num in range(num_pages):
+        lines = [f"Page {page_num} line {line_num}: the quick brown fox jumps over the lazy dog {page_num * line_num}" for line_num in range(lines_per_page)]
+        stream = "BT /F1 10 Tf 12 TL 40 800 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET"
+        stream_bytes = stream.encode("latin-1")
+        objects.append(b"<< /Length " + str(len(stream_bytes)).encode() + b" >>\nstream\n" + stream_bytes + b"\nendstream")
+        content_number = len(objects)
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {content_number} 0 R >>".encode()
+        )
+        page_object_numbers.append(len(objects))
+    kids = " ".join(f"{number} 0 R" for number in page_object_numbers)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {num_pages} >>".encode()
+
+    with open(file_path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(f.tell())
+            f.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+        xref_offset = f.tell()
+        f.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+        for offset in offsets:
+            f.write(f"{offset:010d} 00000 n \n".encode())
+        f.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+
+
+async def run_once(file_path: Path, workers: int)->float:
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        ##warm the workers up so process start-up is not measured
+        await asyncio.gather(*[asyncio.get_running_loop().run_in_executor(pool, pdf_page_count, file_path) for _ in range(workers)])
+        start = perf_counter()
+        ##the pages are consumed as ingestion consumes them, workers ranges extracted ahead of the reader
+        async for _ in iter_file_content(file_path, pool=pool, workers=workers):
+            pass
+        return perf_counter() - start
+
+
+async def main(num_pages: int):
+    cpu_count = os.cpu_count() or 1
+    worker_counts = sorted({1, 2, 4, cpu_count})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = Path(tmp_dir) / "benchmark.pdf"
+        build_pdf(file_path, num_pages)
+        print(f"generated {num_pages} pages pdf ({file_path.stat().st_size / 1024 / 1024:.1f} MB)")
+        baseline = None
+        for workers in worker_counts:
+            elapsed = await run_once(file_path, workers)
+            pages_per_sec = num_pages / elapsed
+            baseline = baseline or pages_per_sec
+            print(f"workers={workers:>3}  elapsed={elapsed:7.2f}s  pages/sec={pages_per_sec:8.1f}  speedup={pages_per_sec / baseline:5.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(main(args.pages))
@@ -0,0 +1,74 @@
+'''
+fusion time of the numpy reciprocal rank fusion against the previous text keyed defaultdict fusion of chromadb_search
+
+usage (from the repo root):
+    python -m benchmarks.rrf_benchmark --hits 200 --rounds 2000
+'''
+import random
+import argparse
+from time import perf_counter
+from collections import defaultdict
+from utils.rank_fusion import reciprocal_rank_fusion, top_k_by_token_budget
+
+
+def build_rankings(num_chunks: int, hits: int, chunk_chars: int = 1000)->tuple[list[str], list[int], list[int]]:
+    '''chunk texts plus a vector and a bm25 ranking of `hits` chunk ids each'''
+    rng = random.Random(7)
+    words = ["retrieval", "fusion", "chunk", "token", "budget", "vector", "lexical", "session", "upload", "index"]
+    documents = []
+    for chunk_id in range(num_chunks):
+        text = f"{chunk_id} "
+        while len(text) < chunk_chars:
+            text += rng.choice(words) + " "
+        documents.append(text[:chunk_chars])
+    vector_ranking = rng.sample(range(num_chunks), hits)
+    bm25_ranking = rng.sample(range(num_chunks), hits)
+    return documents, vector_ranking, bm25_ranking
+
+
+def legacy_fusion(documents: list[str], vector_ranking: list[int], bm25_ranking: list[int])->list[str]:
+    '''the fusion chromadb_search used before utils.rank_fusion'''
+    K = 60
+    scored_chunks = defaultdict(lambda: {"score": 0, "id": None})
+    for rank, chunk_id in enumerate(vector_ranking):
+        scored_chunks[documents[chunk_id]]["score"] += 1 / (K + rank)
+        scored_chunks[documents[chunk_id]]["id"] = chunk_id
+    for rank, chunk_id in enumerate(bm25_ranking):
+        scored_chunks[documents[chunk_id]]["score"] += 1 / (K + rank)
+        scored_chunks[documents[chunk_id]]["id"] = chunk_id ##set here so the old reorder does not fail on lexical only hits
+    sorted_scored_chunks = sorted(scored_chunks.items(), key=lambda item: item[1]["score"], reverse=True)[: int(len(scored_chunks) * 0.7)]
+    reordered_chunks = sorted(sorted_scored_chunks, key=lambda item: item[1]["id"], reverse=False)
+    return [each[0] for each in reordered_chunks]
+
+
+def vectorised_fusion(documents: list[str], token_counts: list[int], vector_ranking: list[int], bm25_ranking: list[int], token_budget: int)->list[str]:
+    chunk_ids, _ = reciprocal_rank_fusion([vector_ranking, bm25_ranking])
+    selected = top_k_by_token_budget(chunk_ids, [token_counts[each] for each in chunk_ids], token_budget)
+    return [documents[each] for each in sorted(selected.tolist())]
+
+
+def time_rounds(func, rounds: int, *args)->float:
+    start = perf_counter()
+    for _ in range(rounds):
+        func(*args)
+    return (perf_counter() - start) / rounds
+
+
+def main(num_chunks: int, hits: int, rounds: int, token_budget: int):
+    documents, vector_ranking, bm25_ranking = build_rankings(num_chunks, hits)
+    token_counts = [len(each) // 4 for each in documents]
+    legacy = time_rounds(legacy_fusion, rounds, documents, vector_ranking, bm25_ranking)
+    vectorised = time_rounds(vectorised_fusion, rounds, documents, token_counts, vector_ranking, bm25_ranking, token_budget)
+    print(f"chunks={num_chunks} hits per retriever={hits} rounds={rounds}")
+    print(f"legacy      {legacy * 1e6:9.1f} us/fusion")
+    print(f"vectorised  {vectorised * 1e6:9.1f} us/fusion  speedup={legacy / vectorised:5.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=5000)
+    parser.add_argument("--hits", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--token-budget", type=int, default=6000)
+    args = parser.parse_args()
+    main(args.chunks, args.hits, args.rounds, args.token_budget)
@@ -3,14 +3,22 @@ import uvicorn
 import uuid
 from routes.ws_routes import ws_router
 from routes.session_routes import session_router
+from routes.metrics_routes import metrics_router
 from utils.agent_setup import agent_compile
 from fastapi.middleware.cors import CORSMiddleware
 from model.sqlite import create_tables
+from model.ingestion_jobs import ingestion_manager
+from utils.helper_funcs import file_ingestion_handler
+from utils.file_content_extractor import shutdown_extraction_pool
+from model.embedding_service import embedding_service
+from model.retrieval_service import retrieval_service
+from model.search_client import search_client
 
 
 app = FastAPI()
 app.include_router(ws_router)
 app.include_router(session_router)
+app.include_router(metrics_router)
 
 origins = ["*"]
 
@@ -21,9 +29,20 @@ app.add_middleware(CORSMiddleware, allow_origins=origins)
 async def startup():
     await create_tables()
     await agent_compile()
+    await ingestion_manager.start(handler=file_ingestion_handler)
+    retrieval_service.start()
     # chromadb_client = Chromadb_agent()
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await ingestion_manager.stop()
+    shutdown_extraction_pool()
+    embedding_service.shutdown()
+    retrieval_service.shutdown()
+    await search_client.aclose()
+
+
 @app.get("/")
 def read_root():
     return {"message": "Hello World"}
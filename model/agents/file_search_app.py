@@ -1,6 +1,9 @@
 import os
 import asyncio
+import heapq
+import numpy as np
 from model.file_parser import Chromadb_agent
+from model.collection_registry import collection_registry
 from langgraph.graph import StateGraph, START
 from typing import TypedDict, Sequence, Annotated, Literal, List
 from langgraph.graph.message import add_messages
@@ -14,9 +17,15 @@ from model import message_event
 from model.session_manager import manager
 from time import time
 from pydantic import BaseModel, Field
+from utils.rank_fusion import reciprocal_rank_fusion, top_k_by_token_budget
+from utils.token_counter import cached_token_counts
+from utils.chunk_merger import merge_adjacent_chunks, neighbour_candidates, expand_with_neighbours
+from utils.context_packer import pack_passages, format_passages
 from collections import defaultdict
-import bm25s.high_level as bm25
-from chromadb.api.models.Collection import Collection
+from model.retrieval_service import retrieval_service
+from chromadb.errors import NotFoundError
+from model.query_cache import query_cache
+from model.dependency.dependencies import get_chromadb_agent_singleton
 from langgraph.errors import GraphRecursionError
 from langchain_openai import ChatOpenAI
 
@@ -27,7 +36,7 @@ load_dotenv()
 class Search_Sentence_Collection(BaseModel):
     """Model for ChromaDB Search Parameters"""
     search_sentences: List[str] = Field(..., description="The search queries or keywords to find relevant content")
-    file_name: str = Field(..., description="The specific file name to search within (e.g., 'document.pdf')")
+    file_name: str | None = Field(default=None, description="The specific file name to search within (e.g., 'document.pdf'), leave it empty to search every file of the session")
 
 
 class File_Search_State(TypedDict):
@@ -42,60 +51,206 @@ class File_Search_State(TypedDict):
 
 summary_model = ChatDeepSeek(model="deepseek-chat", api_key=os.getenv("api_key"), temperature=0, top_p=0.1)
 MAX_SEARCH_ATTEMPTS = 5
+SEARCH_CONCURRENCY = int(os.getenv("search_concurrency", 8)) ##retrieval steps (vector query, bm25 scoring, chunk reads) running at once per tool call
+FILE_SEARCH_TIMEOUT = float(os.getenv("file_search_timeout", 30)) ##seconds before a file is reported as timed out
+SESSION_SEARCH_TOP_K = int(os.getenv("session_search_top_k", 20)) ##passages kept across files by a session wide search
+FILE_SEARCH_TOKEN_BUDGET = int(os.getenv("file_search_token_budget", 6000)) ##tokens of fused chunks kept per searched file
+VECTOR_RRF_WEIGHT = float(os.getenv("vector_rrf_weight", 1.0))
+BM25_RRF_WEIGHT = float(os.getenv("bm25_rrf_weight", 1.0))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("file_search_context_token_budget", 12_000)) ##tokens of passages handed over per tool call
+SUMMARY_PASSTHROUGH_TOKENS = int(os.getenv("file_search_passthrough_tokens", 3000)) ##packed passages under this skip the summary llm
+FILE_SEARCH_NEIGHBOUR_CHUNKS = int(os.getenv("file_search_neighbour_chunks", 0)) ##chunks added on each side of a hit when the budget allows
 
-def vector_search_sort(
-        collection: Collection,
-        search_words: list[str],
-        file_name: str
-    )->list[tuple]:
+async def resolve_collection(thread_id: str, file_name: str)->tuple[str, str | None]:
     '''
-    searching chromadb chunks via search keywords in ONE collections
-    return sorted list of tuple (id, distance, document)
+    (collection name, file hash) of a session's file from the collection registry,
+    files indexed before the registry existed are still looked up by their per session collection name
     '''
-    DISTANCE_THRESHOLD = 1.7
-    MAX_RESULTS = 20
+    registered = await collection_registry.lookup(session_id=thread_id, file_name=file_name)
+    if registered:
+        return registered.collection_name, registered.file_hash
+    return Chromadb_agent.collection_name_normalize(session_id=thread_id, filename=file_name), None
+
+async def fused_chunks(
+        chromadb_agent: Chromadb_agent,
+        collection_name: str,
+        file_hash: str | None,
+        file_name: str,
+        search_sentences: list[str],
+        semaphore: asyncio.Semaphore
+    )->list[tuple[float, int, str]]:
+    '''
+    vector and bm25 search of one file run concurrently, fused by weighted reciprocal rank on chunk positions once both have arrived
+    return (score, chunk position, chunk) sorted by score
+    '''
+    ##the same queries re-issued across rounds and turns skip both retrievers
+    cached_results = query_cache.get(collection_name, file_hash, search_sentences)
+    if cached_results is not None:
+        return cached_results
+    ## vector db search on the server's chromadb client and bm25 serch scored by the retrieval workers which keep the bm25 retrievers warm,
+    ## each retrieval step holds a slot of the tool call's semaphore until its thread or worker is done, even past a timeout
+    filtered_chunks, filterd_bm25_results = await asyncio.gather(
+        retrieval_service.vector_search(chromadb_agent, collection_name, file_hash, search_sentences, limit=semaphore),
+        retrieval_service.bm25_search(chromadb_agent, collection_name, file_hash, search_sentences, limit=semaphore)
+    )
+    documents = {chunk_id: chunk for chunk_id, _, chunk in filtered_chunks}
+    documents.update({each["id"]: each["document"] for each in filterd_bm25_results})
+    chunk_ids, scores = reciprocal_rank_fusion(
+        [[each[0] for each in filtered_chunks], [each["id"] for each in filterd_bm25_results]],
+        weights=[VECTOR_RRF_WEIGHT, BM25_RRF_WEIGHT]
+    )
+    fused_results = [(score, chunk_id, documents[chunk_id]) for chunk_id, score in zip(chunk_ids.tolist(), scores.tolist())]
+    query_cache.put(collection_name, file_hash, search_sentences, fused_results)
+    return fused_results
+
+async def hybrid_search(
+        chromadb_agent: Chromadb_agent,
+        thread_id: str,
+        search_params: Search_Sentence_Collection,
+        semaphore: asyncio.Semaphore
+    )->dict:
+    collection_name, file_hash = await resolve_collection(thread_id=thread_id, file_name=search_params.file_name)
+    ranked_chunks = await fused_chunks(
+        chromadb_agent=chromadb_agent,
+        collection_name=collection_name,
+        file_hash=file_hash,
+        file_name=search_params.file_name,
+        search_sentences=search_params.search_sentences,
+        semaphore=semaphore
+    )
+    ##the best chunks fitting the token budget, back in document order
+    selected_ids = top_k_by_token_budget(
+        np.array([each[1] for each in ranked_chunks], dtype=np.int64),
+        np.array([cached_token_counts(each[2]) for each in ranked_chunks], dtype=np.int64),
+        token_budget=FILE_SEARCH_TOKEN_BUDGET
+    )
+    documents = {chunk_id: chunk for _, chunk_id, chunk in ranked_chunks}
+    hits = {chunk_id: documents[chunk_id] for chunk_id in selected_ids.tolist()}
+    if FILE_SEARCH_NEIGHBOUR_CHUNKS > 0:
+        ##the budget left by the hits goes to the chunks around them, best hit first
+        neighbour_budget = FILE_SEARCH_TOKEN_BUDGET - sum(cached_token_counts(each) for each in hits.values())
+        candidates = neighbour_candidates(hits, FILE_SEARCH_NEIGHBOUR_CHUNKS, neighbour_budget, cached_token_counts)
+        fetched = await retrieval_service.fetch_chunks(chromadb_agent, collection_name, file_hash, candidates, limit=semaphore)
+        hits = expand_with_neighbours(hits, candidates, fetched, neighbour_budget, cached_token_counts)
+    ##consecutive chunks are stitched into one passage without the repeated overlap, scored by its best chunk
+    scores = {chunk_id: score for score, chunk_id, _ in ranked_chunks}
+    return {
+        "file": search_params.file_name,
+        "queries": search_params.search_sentences,
+        "passages": [
+            {
+                "file": search_params.file_name,
+                "chunk_ids": [first_id, last_id],
+                "score": max(scores.get(chunk_id, 0.0) for chunk_id in range(first_id, last_id + 1)),
+                "content": text
+            }
+            for first_id, last_id, text in merge_adjacent_chunks(hits.items())
+        ]
+    }
+
+async def session_search(
+        chromadb_agent: Chromadb_agent,
+        thread_id: str,
+        search_sentences: list[str],
+        semaphore: asyncio.Semaphore
+    )->dict:
+    '''
+    search every indexed file of the session in parallel and merge the per file rankings into one global top k
+    with a bounded min heap, each result keeps the file it came from
+    '''
+    indexed_files = await collection_registry.list_session(session_id=thread_id)
+    if not indexed_files:
+        return {
+            "scope": "session",
+            "query": search_sentences,
+            "error": "No indexed file found in session"
+        }
+    ranked_lists = await asyncio.gather(*[
+        asyncio.wait_for(
+            fused_chunks(
+                chromadb_agent=chromadb_agent,
+                collection_name=registered.collection_name,
+                file_hash=registered.file_hash,
+                file_name=registered.file_name,
+                search_sentences=search_sentences,
+                semaphore=semaphore
+            ),
+            timeout=FILE_SEARCH_TIMEOUT
+        )
+        for registered in indexed_files
+    ], return_exceptions=True)
+
+    top_chunks = [] ##min heap of (score, sequence, file name, chunk position, chunk)
+    errors = []
+    sequence = 0
+    for registered, ranked_chunks in zip(indexed_files, ranked_lists):
+        file_name = registered.file_name
+        if isinstance(ranked_chunks, asyncio.TimeoutError):
+            errors.append({"file": file_name, "error": f"Search in '{file_name}' timed out after {FILE_SEARCH_TIMEOUT} seconds"})
+            continue
+        if isinstance(ranked_chunks, Exception):
+            errors.append({"file": file_name, "error": str(ranked_chunks)})
+            continue
+        for score, chunk_id, chunk in ranked_chunks:
+            if len(top_chunks) < SESSION_SEARCH_TOP_K:
+                heapq.heappush(top_chunks, (score, sequence, file_name, chunk_id, chunk))
+            elif score > top_chunks[0][0]:
+                heapq.heapreplace(top_chunks, (score, sequence, file_name, chunk_id, chunk))
+            else:
+                break ##the rest of this file's ranking scores lower
+            sequence += 1
+    ##consecutive hits of a file are stitched into one passage scored by its best chunk
+    file_hits = defaultdict(dict)
+    for score, _, file_name, chunk_id, chunk in top_chunks:
+        file_hits[file_name][chunk_id] = (score, chunk)
+    results = []
+    for file_name, hits in file_hits.items():
+        for first_id, last_id, text in merge_adjacent_chunks((chunk_id, chunk) for chunk_id, (_, chunk) in hits.items()):
+            score = max(hits[chunk_id][0] for chunk_id in range(first_id, last_id + 1) if chunk_id in hits)
+            results.append({"file": file_name, "chunk_ids": [first_id, last_id], "score": score, "content": text})
+    results.sort(key=lambda x: x["score"], reverse=True)
+    return {
+        "scope": "session",
+        "queries": search_sentences,
+        "passages": results,
+        "errors": errors
+    }
+
+async def search_file(
+        chromadb_agent: Chromadb_agent,
+        thread_id: str,
+        search_params: Search_Sentence_Collection,
+        semaphore: asyncio.Semaphore
+    )->dict:
+    '''
+    hybrid search of one file under FILE_SEARCH_TIMEOUT, a failing or slow file only turns into an error entry,
+    without a file name every indexed file of the session is searched
+    '''
+    if search_params.file_name is None:
+        return await session_search(chromadb_agent=chromadb_agent, thread_id=thread_id, search_sentences=search_params.search_sentences, semaphore=semaphore)
     try:
-        ##perform search query in the vector DB
-        results = collection.query(
-            query_texts=search_words,
-            n_results=MAX_RESULTS,
-            include=["documents", "metadatas", "distances"]
+        return await asyncio.wait_for(
+            hybrid_search(chromadb_agent=chromadb_agent, thread_id=thread_id, search_params=search_params, semaphore=semaphore),
+            timeout=FILE_SEARCH_TIMEOUT
         )
-        ##merge and scored each chunk
-        filtered_chunks = []
-        if results["ids"]:
-            for id in range(len(results["ids"])): ## for example there are 4 search words for the prompt
-                merged_chunks = list(zip(results["ids"][id], results["distances"][id], results["documents"][id]))
-                filtered_chunks += [each for each in merged_chunks if each[1] < DISTANCE_THRESHOLD]
-        filtered_chunks.sort(key=lambda x:x[1])
-        return filtered_chunks
-    except ValueError:
-        return [str({
-            "file": file_name,
-            "query": search_words,
-            "error": f"File '{file_name}' not found in session"
-        })]
+    except asyncio.TimeoutError:
+        return {
+            "file": search_params.file_name,
+            "query": search_params.search_sentences,
+            "error": f"Search in '{search_params.file_name}' timed out after {FILE_SEARCH_TIMEOUT} seconds"
+        }
+    except (ValueError, NotFoundError):
+        return {
+            "file": search_params.file_name,
+            "query": search_params.search_sentences,
+            "error": f"File '{search_params.file_name}' not found in session"
+        }
     except Exception as e:
-        return [str({
-            "file": file_name,
-            "query": search_words,
+        return {
+            "file": search_params.file_name,
+            "query": search_params.search_sentences,
             "error": str(e)
-        })]
-    
-def bm25_search_sort(
-        collection: Collection, 
-        search_keywords: list[str],
-    )->list[dict]:
-    '''
-    return list of sorted and merged dict {"id": 1, "score": 1.1, "document": "xxx"}
-    '''
-    all_chunks = collection.get(include=["documents"])
-    retriever = bm25.index(all_chunks["documents"])
-    bm25_results =[each_chunk for each in retriever.search(search_keywords) for each_chunk in each]
-    filterd_bm25_results = [each for each in bm25_results if each["score"] > 0]
-    filterd_bm25_results.sort(key=lambda x: x["score"], reverse=True)
-    return filterd_bm25_results
-
+        }
 
 
 @tool
@@ -113,7 +268,8 @@ async def chromadb_search(
     Args:
         search_collection_list: List of search parameters, each containing:
             - search_sentences: The query or keywords to search for
-            - file_name: The specific file to search within
+            - file_name: The specific file to search within, omit it to search all uploaded files at once
+              and get the best passages across files, each labelled with its file
         thread_id: The current session ID (automatically injected)
     
     Returns:
@@ -121,68 +277,45 @@ async def chromadb_search(
     Example:
         To search for "neural networks" in "ai_paper.pdf":
         [{"search_sentences": ["neural networks", "RHLF"], "file_name": "ai_paper.pdf"}]
+        To search for "quarterly revenue" when it is unclear which file holds it:
+        [{"search_sentences": ["quarterly revenue"]}]
     """
     system_prompt = "Please summarize the contents extracted from the the files, the output should be " \
     "file: $file_name, relevent_content: $summary. Please Notice there are might be irrelevant information or duplicates in content chunks"
-    ##for vector db search
-    K = 60
-    all_results = []
+    chromadb_agent = get_chromadb_agent_singleton()
+    ##every (file, retriever) pair runs at once, bounded by the semaphore
+    semaphore = asyncio.Semaphore(SEARCH_CONCURRENCY)
+    all_results = await asyncio.gather(*[
+        search_file(chromadb_agent=chromadb_agent, thread_id=thread_id, search_params=search_params, semaphore=semaphore)
+        for search_params in search_collection_list
+    ])
 
-    chromadb_agent = Chromadb_agent()
-    for search_params in search_collection_list:
-        scored_chunks = defaultdict(lambda: {"score": 0, "id": None})
-        try:
-            normalized_collection_name = Chromadb_agent.collection_name_normalize(session_id=thread_id, filename=search_params.file_name)
-            collection = chromadb_agent.chromadb_client.get_collection(normalized_collection_name)
-            ## vector db search
-            filtered_chunks = await asyncio.to_thread(vector_search_sort, collection, search_params.search_sentences, search_params.file_name)
-
-            ## bm25 serch
-            filterd_bm25_results = await asyncio.to_thread(bm25_search_sort, collection, search_params.search_sentences)
-            
-            for rank, (chunk_id, _, chunk) in enumerate(filtered_chunks):
-                scored_chunks[chunk]["score"] += 1 / (K + rank)
-                scored_chunks[chunk]["id"] = int(chunk_id.split("_")[-1])
-            
-            for rank, each in enumerate(filterd_bm25_results):
-                scored_chunks[each["document"]]["score"] += 1 / (K + rank)
-            
-            sorted_scored_chunks = sorted(scored_chunks.items(), key=lambda item: item[1]["score"], reverse=True)[: int(len(scored_chunks) * 0.7)]
-            reordered_chunks = sorted(sorted_scored_chunks, key=lambda item: item[1]["id"], reverse=False)
-            all_results.append(str({
-                "file": search_params.file_name,
-                "relevant_content": "\n".join([each[0] for each in reordered_chunks]),
-                "queries": search_params.search_sentences
-            }))
-        except ValueError:
-            all_results.append(str({
-                "file": search_params.file_name,
-                "query": search_params.search_sentences,
-                "error": f"File '{search_params.file_name}' not found in session"
-            }))
-        except Exception as e:
-            all_results.append(str({
-                "file": search_params.file_name,
-                "query": search_params.search_sentences,
-                "error": str(e)
-            }))
-
-    if all_results:
-        raw_relevant_contents = "\n".join(all_results)
-        response = await summary_model.ainvoke(
-            [SystemMessage(system_prompt)] + [AIMessage(raw_relevant_contents)] 
-        )
+    ##rank every passage across the searches and fill the context budget greedily
+    passages = [passage for result in all_results for passage in result.get("passages", [])]
+    errors = [result for result in all_results if "error" in result]
+    errors += [error for result in all_results for error in result.get("errors", [])]
+    packed_passages, packed_tokens = pack_passages(passages, token_budget=CONTEXT_TOKEN_BUDGET)
+    if not packed_passages and not errors:
         return ToolMessage(
             tool_call_id=tool_call_id, 
-            content=response.content, 
+            content="No relevant information found in the uploads", 
             # additional_kwargs=event.model_dump()
         )
-    else:
+    raw_relevant_contents = format_passages(packed_passages, errors=errors)
+    if packed_tokens <= SUMMARY_PASSTHROUGH_TOKENS:
+        ##small enough to hand over as is, no summarisation call
         return ToolMessage(
             tool_call_id=tool_call_id, 
-            content="No relevant information found in the uploads", 
-            # additional_kwargs=event.model_dump()
+            content=raw_relevant_contents, 
         )
+    response = await summary_model.ainvoke(
+        [SystemMessage(system_prompt)] + [AIMessage(raw_relevant_contents)] 
+    )
+    return ToolMessage(
+        tool_call_id=tool_call_id, 
+        content=response.content, 
+        # additional_kwargs=event.model_dump()
+    )
 
 
 file_search_model = ChatDeepSeek(model="deepseek-chat", api_key=os.getenv("api_key"), temperature=0, top_p=0.1).bind_tools([chromadb_search])
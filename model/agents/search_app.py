@@ -1,4 +1,4 @@
-import os, asyncio, json
+import os, asyncio, json, hashlib
 from time import time
 from typing import TypedDict, Annotated, Sequence, List, Literal
 from langchain_core.messages import BaseMessage, SystemMessage, HumanMessage, ToolMessage
@@ -6,16 +6,29 @@ from langgraph.graph.message import add_messages
 from langchain_deepseek import ChatDeepSeek
 from langgraph.prebuilt import InjectedState, ToolNode
 from langchain_core.tools import tool
-from tavily import AsyncTavilyClient
 from model.session_manager import manager
+from model.search_cache import search_cache
+from model.search_client import search_client
+from functools import partial
+from utils.token_counter import truncate_to_tokens
 import model.message_event as message_event
 from langgraph.types import Command
 from langgraph.graph import START, StateGraph
 from dotenv import load_dotenv
-import re
 
 load_dotenv()
 
+TAVILY_MAX_RESULTS = int(os.getenv("tavily_max_results", 5))
+TAVILY_SEARCH_DEPTH = os.getenv("tavily_search_depth", "basic")
+SEARCH_OPTIONS = {"max_results": TAVILY_MAX_RESULTS, "search_depth": TAVILY_SEARCH_DEPTH} ##part of the search cache key
+SEARCH_SUMMARY_CONCURRENCY = int(os.getenv("search_summary_concurrency", 4)) ##topic summaries requested from the llm at once
+SEARCH_MAX_ROUNDS = int(os.getenv("search_max_rounds", 3)) ##search_tool rounds per turn
+SEARCH_MAX_UPSTREAM_CALLS = int(os.getenv("search_max_upstream_calls", 12)) ##topics searched per turn
+SEARCH_MIN_NOVELTY = float(os.getenv("search_min_novelty", 0.2)) ##stop once a round brings less than this fraction of new content
+SEARCH_SOURCE_MAX_TOKENS = int(os.getenv("search_source_max_tokens", 800)) ##content tokens kept per source
+SEARCH_ROUND_TOKEN_BUDGET = int(os.getenv("search_round_token_budget", 12_000)) ##source tokens sent to the topic summaries of one search_tool round
+SOURCE_OVERHEAD_TOKENS = 8 ##json keys and separators around each source
+
 class Search_State(TypedDict):
     messages: Annotated[Sequence[BaseMessage], add_messages]
     search_count: int
@@ -23,7 +36,12 @@ class Search_State(TypedDict):
     thread_id: str
     tool_call_id: str
     pause_required: bool
-    total_links: int
+    total_links: int ##distinct links found in this turn
+    seen_urls: list[str]
+    seen_hashes: list[str] ##sha256 of the normalised content of every source already summarised
+    search_round: int
+    upstream_calls: int
+    novelty: float ##fraction of the content of the last round which was new
 
 
 def clean_text(text) -> str:
@@ -32,49 +50,10 @@ def clean_text(text) -> str:
         return ""
     if not isinstance(text, str):
         text = str(text)
-    
-    # Remove surrogate characters (U+D800 to U+DFFF)
-    cleaned = re.sub(r'[\ud800-\udfff]', '', text)
-    # Remove other problematic characters
-    cleaned = cleaned.encode('utf-8', errors='ignore').decode('utf-8')
-    
-    return cleaned
-
-def clean_dict(d) -> dict:
-    """Recursively clean all strings in a dictionary"""
-    if not isinstance(d, dict):
-        return d
-    
-    cleaned = {}
-    for key, value in d.items():
-        if isinstance(value, str):
-            cleaned[key] = clean_text(value)
-        elif isinstance(value, dict):
-            cleaned[key] = clean_dict(value)
-        elif isinstance(value, list):
-            cleaned[key] = [
-                clean_dict(item) if isinstance(item, dict)
-                else clean_text(item) if isinstance(item, str)
-                else item
-                for item in value
-            ]
-        else:
-            cleaned[key] = value
-    return cleaned
-
-def safe_json_dumps(obj) -> str:
-    """Safely convert object to JSON string"""
-    try:
-        if isinstance(obj, dict):
-            obj = clean_dict(obj)
-        elif isinstance(obj, list):
-            obj = [clean_dict(item) if isinstance(item, dict) else item for item in obj]
-        
-        return json.dumps(obj, ensure_ascii=False, default=str)
-    except Exception as e:
-        print(f"JSON encoding error: {e}, falling back to ensure_ascii=True")
-        return json.dumps(obj, ensure_ascii=True, default=str)
-
+    if text.isascii():
+        return text
+    # One utf-8 round trip drops the surrogates (U+D800 to U+DFFF) and other unencodable characters
+    return text.encode('utf-8', errors='ignore').decode('utf-8')
 
 search_summary_model = ChatDeepSeek(
     model="deepseek-chat", 
@@ -83,12 +62,168 @@ search_summary_model = ChatDeepSeek(
     extra_body={"thinking": {"type": "disabled"}}
 )
 
+class RoundTokenBudget:
+    '''
+    the source tokens of one search_tool round shared by its topics, each topic takes an equal share of what is left
+    when its sources arrive, so the first topics cannot starve the others and tokens a topic leaves go to the later ones
+    '''
+    def __init__(self, token_budget: int, topic_count: int):
+        self.remaining = token_budget
+        self.waiting = topic_count ##topics which have not taken their share yet
+
+    def take(self)->int:
+        share = self.remaining // max(1, self.waiting)
+        self.waiting -= 1
+        return share
+
+    def spend(self, tokens: int):
+        self.remaining -= tokens
+
+    def skip(self):
+        '''a topic leaving without taking its share'''
+        self.waiting -= 1
+
+def budget_search_result(
+        result: dict,
+        source_max_tokens: int,
+        token_budget: int
+    )->tuple[dict, list[dict], int]:
+    '''
+    the sources of one tavily response ranked by tavily score, each cleaned once and cut to source_max_tokens of content,
+    kept while they fit in token_budget (title, content and score only)
+    return ({"query", "results"}, the kept sources as given, tokens used)
+    '''
+    mapped_sources = []
+    kept_sources = []
+    used_tokens = 0
+    for source in sorted(result.get("results", []), key=lambda x: x.get("score") or 0, reverse=True):
+        remaining = token_budget - used_tokens - SOURCE_OVERHEAD_TOKENS
+        title, title_tokens = truncate_to_tokens(clean_text(source.get("title", "")), remaining)
+        if remaining - title_tokens <= 0:
+            break
+        content, content_tokens = truncate_to_tokens(clean_text(source.get("content", "")), min(source_max_tokens, remaining - title_tokens))
+        if not content:
+            continue
+        mapped_sources.append({"title": title, "content": content, "score": source.get("score")})
+        kept_sources.append(source)
+        used_tokens += title_tokens + content_tokens + SOURCE_OVERHEAD_TOKENS
+    return {"query": clean_text(result.get("query", "")), "results": mapped_sources}, kept_sources, used_tokens
+
+def content_hash(source: dict)->str:
+    return hashlib.sha256(" ".join(str(source.get("content", "")).lower().split()).encode("utf-8", errors="ignore")).hexdigest()
+
+def drop_seen_sources(result: dict, seen_urls: set[str], seen_hashes: set[str])->tuple[dict, int]:
+    '''
+    the result without the sources whose url or content was already seen in this turn (or earlier in the result),
+    return (result, content chars of every source)
+    '''
+    new_sources = []
+    total_chars = 0
+    result_urls = set()
+    result_hashes = set()
+    for source in result.get("results", []):
+        total_chars += len(str(source.get("content", "")))
+        source_hash = content_hash(source)
+        url = source.get("url")
+        if url in seen_urls or url in result_urls or source_hash in seen_hashes or source_hash in result_hashes:
+            continue
+        if url:
+            result_urls.add(url)
+        result_hashes.add(source_hash)
+        new_sources.append(source)
+    return {**result, "results": new_sources}, total_chars
+
+def mark_seen(sources: list[dict], seen_urls: set[str], seen_hashes: set[str])->int:
+    '''
+    reserve the sources as seen so the other topics of the round skip them, forget_sources hands them back
+    when they could not be summarized, return their content chars
+    '''
+    for source in sources:
+        if source.get("url"):
+            seen_urls.add(source["url"])
+        seen_hashes.add(content_hash(source))
+    return sum(len(str(source.get("content", ""))) for source in sources)
+
+def forget_sources(sources: list[dict], seen_urls: set[str], seen_hashes: set[str]):
+    '''undo mark_seen for sources which were not summarized, so a later round can pick them up'''
+    for source in sources:
+        seen_urls.discard(source.get("url"))
+        seen_hashes.discard(content_hash(source))
+
+async def search_and_summarize(
+        topic: str,
+        thread_id: str,
+        semaphore: asyncio.Semaphore,
+        seen_urls: set[str],
+        seen_hashes: set[str],
+        round_budget: RoundTokenBudget
+    )->dict:
+    '''
+    map step, search one topic and summarize its unseen sources on their own as soon as they arrive,
+    the sources are cut to the topic's share of the round budget and stay seen only once their summary succeeded,
+    return {"topic", "links", "summary", "total_chars", "new_chars"} (summary is None when nothing was new) or {"topic", "error"}
+    '''
+    kept_sources = []
+    share = None
+    try:
+        ##the same topic asked by any session within the ttl is answered from the search cache,
+        ##misses go through the shared rate limited client
+        result = await search_cache.get_or_fetch(topic, SEARCH_OPTIONS, partial(search_client.search, topic, session_id=thread_id, **SEARCH_OPTIONS))
+        ##no await between the check and marking the kept sources, so topics of the same round also dedup against each other,
+        ##sources left out by the token budget stay unseen for a later round
+        result, total_chars = drop_seen_sources(result, seen_urls, seen_hashes)
+        if not result["results"]:
+            return {"topic": topic, "links": [], "summary": None, "total_chars": total_chars, "new_chars": 0}
+        share = round_budget.take()
+        mapped_result, kept_sources, used_tokens = budget_search_result(result, SEARCH_SOURCE_MAX_TOKENS, share)
+        round_budget.spend(used_tokens)
+        if not kept_sources:
+            return {"topic": topic, "links": [], "summary": None, "total_chars": total_chars, "new_chars": 0}
+        new_chars = mark_seen(kept_sources, seen_urls, seen_hashes)
+        links = [source["url"] for source in kept_sources if source.get("url")]
+        async with semaphore:
+            response = await search_summary_model.ainvoke([
+                SystemMessage(content=f'''Please summarize the search result without losing any important information but remove all irrelevance.
+Topic: {topic}
+'''),
+                ##already cleaned by budget_search_result
+                HumanMessage(content=json.dumps(mapped_result, ensure_ascii=False))
+            ])
+        return {
+            "topic": topic,
+            "links": links,
+            "summary": clean_text(response.content),
+            "total_chars": total_chars,
+            "new_chars": new_chars
+        }
+    except Exception as e:
+        print(f"Search tool error on '{topic}': {e}")
+        forget_sources(kept_sources, seen_urls, seen_hashes)
+        return {"topic": topic, "error": str(e)}
+    finally:
+        if share is None:
+            round_budget.skip()
+
+async def reduce_search_summaries(topics: list[str], summaries: list[dict])->str:
+    '''reduce step, merge the per topic summaries into one answer'''
+    if len(summaries) == 1:
+        return summaries[0]["summary"]
+    partial_summaries = "\n\n".join(f"## {each['topic']}\n{each['summary']}" for each in summaries)
+    response = await search_summary_model.ainvoke([
+        SystemMessage(content=f'''These are the summaries of the search results of each topic. Please merge them into one summary without losing any important information, remove the repeated parts.
+Topics: {', '.join(topics)}
+'''),
+        HumanMessage(content=partial_summaries)
+    ])
+    return clean_text(response.content)
+
 @tool
 async def search_tool(
     thread_id: Annotated[str, InjectedState("thread_id")], 
     tool_call_id: Annotated[str, InjectedState("tool_call_id")],
+    search_state: Annotated[dict, InjectedState],
     topics: List[str] = [], 
-) -> ToolMessage:
+) -> Command:
     '''
     search_tool is for finding the relevant information over the internet via the tavily client
     Args:
@@ -96,42 +231,61 @@ async def search_tool(
     Return:
         ToolMessage with summarized search results
     '''
+    semaphore = asyncio.Semaphore(SEARCH_SUMMARY_CONCURRENCY)
+    seen_urls = set(search_state.get("seen_urls") or [])
+    seen_hashes = set(search_state.get("seen_hashes") or [])
+    upstream_calls = search_state.get("upstream_calls", 0)
+    ##topics over the upstream budget of the turn are not searched
+    topics = list(dict.fromkeys(topics))[: max(0, SEARCH_MAX_UPSTREAM_CALLS - upstream_calls)]
+    total_chars = 0
+    new_chars = 0
     try:
-        tavily_api_key = os.getenv("tavily_api_key")
-        client = AsyncTavilyClient(api_key=tavily_api_key)
-        
-        corotines = [client.search(topic) for topic in topics]
-        results = await asyncio.gather(*corotines)
-        
         total_links = []
-        max_response_time = 0
-        mapped_results = []
-        
-        for each in results:
-            # Clean query
-            query = clean_text(each.get("query", ""))
-            
-            # Clean and process results
-            cleaned_results = []
-            for single_source in each.get("results", []):
-                cleaned_source = {
-                    k: clean_text(v) if isinstance(v, str) else v 
-                    for k, v in single_source.items() 
-                    if k != "url"
-                }
-                cleaned_results.append(cleaned_source)
-                
-                if "url" in single_source:
-                    total_links.append(single_source["url"])
-            
-            mapped_results.append({
-                "query": query,
-                "results": cleaned_results
-            })
-            
-            max_response_time = max(max_response_time, each.get("response_time", 0))
-        
-        # Send event
+        summaries = []
+        errors = []
+        ##each topic is searched and summarized on its own, the user hears about each one as it completes
+        round_budget = RoundTokenBudget(SEARCH_ROUND_TOKEN_BUDGET, len(topics))
+        for completed in asyncio.as_completed([
+            search_and_summarize(topic, thread_id, semaphore, seen_urls, seen_hashes, round_budget) for topic in topics
+        ]):
+            each = await completed
+            if "error" in each:
+                errors.append(each)
+                continue
+            total_chars += each["total_chars"]
+            new_chars += each["new_chars"]
+            if each["summary"] is None:
+                continue
+            summaries.append(each)
+            total_links += each["links"]
+            topic_event = message_event.Event(
+                type = "search_event",
+                sender = "search_agent",
+                content = f"Summarized results of '{each['topic']}' from {len(each['links'])} links.",
+                links = each["links"],
+                timestamp = time(),
+                message_user = True
+            )
+            await manager.send_event(thread_id=thread_id, event=topic_event.model_dump())
+        if errors and len(errors) == len(topics):
+            print("Search tool error: every topic failed")
+            return search_error(
+                tool_call_id,
+                "; ".join(f"{each['topic']}: {each['error']}" for each in errors),
+                upstream_calls + len(topics),
+                novelty=0.0
+            )
+        if summaries:
+            ##keep the topic order of the request in the reduce prompt
+            summaries.sort(key=lambda each: topics.index(each["topic"]))
+            cleaned_response = await reduce_search_summaries(topics, summaries)
+        elif topics:
+            cleaned_response = "The search found no new sources, every result was already summarized in an earlier round."
+        else:
+            cleaned_response = "The search budget of this turn is used up, no more topics were searched."
+        if errors:
+            cleaned_response += "\n\nSearch failed for: " + ", ".join(each["topic"] for each in errors)
+
         event = message_event.Event(
             type = "search_event",
             sender = "search_agent",
@@ -141,48 +295,45 @@ async def search_tool(
             output_tokens = 0,
             total_tokens = 0,
             timestamp = time(),
-            message_user = True
+            message_user = False
         )
-        await manager.send_event(thread_id=thread_id, event=event.model_dump())
-        
-        # Summarize with safe JSON
-        system_message = f'''Please summarize the search result without losing any important information but remove all irrelevance.
-Topics: {', '.join(topics)}
-'''
-        
-        results_json = safe_json_dumps({"mapped_results": mapped_results})
-        
-        all_messages = [
-            SystemMessage(content=system_message),
-            HumanMessage(content=results_json)
-        ]
-        
-        response = await search_summary_model.ainvoke(all_messages)
         
-        # Clean response
-        cleaned_response = clean_text(response.content)
-        
-        return ToolMessage(
-            tool_call_id=tool_call_id,
-            content=cleaned_response,
-            additional_kwargs={**event.model_dump(), "message_user": False}
-        )
+        return Command(update={
+            "messages": [ToolMessage(
+                tool_call_id=tool_call_id,
+                content=cleaned_response,
+                additional_kwargs=event.model_dump()
+            )],
+            "seen_urls": list(seen_urls),
+            "seen_hashes": list(seen_hashes),
+            "total_links": len(seen_urls),
+            "upstream_calls": upstream_calls + len(topics),
+            "novelty": new_chars / total_chars if total_chars else 0.0
+        })
         
     except Exception as e:
         print(f"Search tool error: {e}")
-        event = message_event.Event(
-            type = "search_tool_error",
-            sender = "search_agent",
-            message_user = False,
-            error = True,
-            timestamp = time()
-        )
-        return ToolMessage(
+        ##the summaries of this round are lost, so its sources are not kept as seen
+        return search_error(tool_call_id, str(e), upstream_calls + len(topics), novelty=new_chars / total_chars if total_chars else 0.0)
+
+def search_error(tool_call_id: str, error: str, upstream_calls: int, novelty: float)->Command:
+    '''the error reply of search_tool, the upstream calls of the round still count against the turn'''
+    event = message_event.Event(
+        type = "search_tool_error",
+        sender = "search_agent",
+        message_user = False,
+        error = True,
+        timestamp = time()
+    )
+    return Command(update={
+        "messages": [ToolMessage(
             tool_call_id=tool_call_id,
-            content=f"Search encountered an error: {str(e)}",
+            content=f"Search encountered an error: {error}",
             additional_kwargs=event.model_dump()
-        )
-
+        )],
+        "upstream_calls": upstream_calls,
+        "novelty": novelty
+    })
 
 search_model = ChatDeepSeek(
     model="deepseek-chat", 
@@ -197,10 +348,18 @@ async def search_agent(state: Search_State)->Command[Literal["__end__", "search_
     "for search the information you MUST use the search tool I provide"
     followup_systme_prompt = "You should decide whether the information search tool found is enough to answer the question or not, if not please give the topic list on what should be searched next"
     system_prompt = followup_systme_prompt if isinstance(state["messages"][-1], ToolMessage) else init_system_prompt
-    
-    ##state["messages"][-1].additional_kwargs["total_num_links"]
+    search_round = state.get("search_round", 0)
+
+    ##the round budget is used up or the last round found little new content, answer with what was found so far
+    stop_searching = search_round > 0 and (
+        search_round >= SEARCH_MAX_ROUNDS
+        or state.get("upstream_calls", 0) >= SEARCH_MAX_UPSTREAM_CALLS
+        or state.get("novelty", 1.0) < SEARCH_MIN_NOVELTY
+    )
+    if stop_searching:
+        system_prompt = "The search is complete, no more searches are allowed. Answer with the information the search tool found so far."
     all_messages = state["messages"] + [SystemMessage(content=system_prompt)] 
-    response = await search_model.ainvoke(all_messages)
+    response = await (search_summary_model if stop_searching else search_model).ainvoke(all_messages)
     event = message_event.Event(
         type = "search agent summarizing results",
         sender = "search_agent",
@@ -220,7 +379,8 @@ async def search_agent(state: Search_State)->Command[Literal["__end__", "search_
                 "sender": "search_agent",
                 "search_count": len(response.tool_calls[0]["args"].get("topics", [])),
                 "thread_id": state["thread_id"],
-                "tool_call_id": response.tool_calls[0]['id']
+                "tool_call_id": response.tool_calls[0]['id'],
+                "search_round": search_round + 1
             }
         )
     else:
@@ -0,0 +1,107 @@
+import os
+import json
+import shutil
+import bm25s
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BM25_INDEX_DIR = os.getenv("bm25_index_dir", "./chromadb_data/bm25")
+BM25_STOPWORDS = "en"
+CHUNK_IDS_FILE = "chunk_ids.json"
+
+
+def tokenize(texts: list[str])->list[list[str]]:
+    '''the same tokenization is used for the chunks and the queries'''
+    return bm25s.tokenize(texts, stopwords=BM25_STOPWORDS, return_ids=False, show_progress=False)
+
+
+class Bm25IndexBuilder:
+    '''
+    collect the chunk tokens as the chunks stream through indexing,
+    tokens are interned into one vocabulary so only token ids are held per chunk
+    '''
+    def __init__(self):
+        self.vocab: dict[str, int] = {}
+        self.corpus_token_ids: list[list[int]] = []
+        self.chunk_ids: list[str] = []
+
+    def add(self, chunk_ids: list[str], chunks: list[str]):
+        for chunk_id, tokens in zip(chunk_ids, tokenize(chunks)):
+            self.corpus_token_ids.append([self.vocab.setdefault(token, len(self.vocab)) for token in tokens])
+            self.chunk_ids.append(chunk_id)
+
+    def build(self)->bm25s.BM25:
+        retriever = bm25s.BM25()
+        retriever.index((self.corpus_token_ids, self.vocab), show_progress=False)
+        return retriever
+
+
+def bm25_search(retriever: bm25s.BM25, chunk_ids: list[str], queries: list[str], k: int)->list[tuple[str, float]]:
+    '''
+    (chunk id, score) of the top k chunks of every query with a positive score
+    '''
+    query_tokens = [
+        [token for token in tokens if token in retriever.vocab_dict]
+        for tokens in tokenize(queries)
+    ]
+    query_tokens = [tokens for tokens in query_tokens if tokens]
+    if not query_tokens:
+        return []
+    documents, scores = retriever.retrieve(query_tokens, k=min(k, len(chunk_ids)), show_progress=False)
+    return [
+        (chunk_ids[document], float(score))
+        for query_documents, query_scores in zip(documents, scores)
+        for document, score in zip(query_documents, query_scores)
+        if score > 0
+    ]
+
+def bm25_size_bytes(retriever: bm25s.BM25, chunk_ids: list[str])->int:
+    '''approximate memory held by a loaded retriever, the score arrays plus the vocabulary and chunk id strings'''
+    PYTHON_STR_OVERHEAD = 50
+    array_bytes = sum(getattr(each, "nbytes", 0) for each in retriever.scores.values())
+    vocab_bytes = sum(len(token) + PYTHON_STR_OVERHEAD for token in retriever.vocab_dict)
+    return array_bytes + vocab_bytes + sum(len(each) + PYTHON_STR_OVERHEAD for each in chunk_ids)
+
+
+class Bm25IndexStore:
+    '''
+    bm25s indexes saved next to the chromadb collections (one directory per collection) and loaded memory mapped,
+    loaded retrievers are kept warm by the retrieval cache
+    '''
+    def __init__(self, index_dir: str = BM25_INDEX_DIR):
+        self.index_dir = index_dir
+
+    def index_path(self, collection_name: str)->str:
+        return os.path.join(self.index_dir, collection_name)
+
+    def save(self, collection_name: str, builder: Bm25IndexBuilder):
+        '''build the index of the collection and replace the saved one'''
+        self.invalidate(collection_name)
+        if not builder.chunk_ids:
+            return
+        retriever = builder.build()
+        index_path = self.index_path(collection_name)
+        partial_path = f"{index_path}.part"
+        shutil.rmtree(partial_path, ignore_errors=True)
+        retriever.save(partial_path, show_progress=False)
+        with open(os.path.join(partial_path, CHUNK_IDS_FILE), "w", encoding="utf-8") as f:
+            json.dump(builder.chunk_ids, f)
+        os.replace(partial_path, index_path)
+
+    def load(self, collection_name: str)->tuple[bm25s.BM25, list[str]] | None:
+        '''(retriever, chunk id of each indexed document), None when the collection has no saved index'''
+        index_path = self.index_path(collection_name)
+        if not os.path.exists(index_path):
+            return None
+        retriever = bm25s.BM25.load(index_path, mmap=True, show_progress=False)
+        with open(os.path.join(index_path, CHUNK_IDS_FILE), "r", encoding="utf-8") as f:
+            chunk_ids = json.load(f)
+        return retriever, chunk_ids
+
+    def invalidate(self, collection_name: str):
+        '''drop the saved index, e.g. when the collection is rebuilt or deleted'''
+        shutil.rmtree(self.index_path(collection_name), ignore_errors=True)
+
+
+bm25_index_store = Bm25IndexStore()
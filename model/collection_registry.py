@@ -0,0 +1,91 @@
+from datetime import datetime
+from sqlalchemy import select, and_, delete
+from model.sqlite import AsyncSessionLocal, RegisteredCollection
+
+
+class CollectionRegistry:
+    '''
+    session_id -> file_name -> (collection name, file_hash, chunk count), kept in the app sqlite db,
+    every lookup is an indexed query instead of a chromadb list_collections() scan
+    '''
+    async def register(
+            self,
+            session_id: str,
+            file_name: str,
+            collection_name: str,
+            file_hash: str | None,
+            chunk_count: int | None = None
+        )->RegisteredCollection:
+        '''
+        point the session's file at the collection, chunk_count defaults to the count already registered for the collection
+        '''
+        async with AsyncSessionLocal() as db:
+            if chunk_count is None:
+                result = await db.execute(
+                    select(RegisteredCollection.chunk_count).where(RegisteredCollection.collection_name == collection_name).limit(1)
+                )
+                chunk_count = result.scalar_one_or_none() or 0
+            result = await db.execute(
+                select(RegisteredCollection).where(
+                    and_(
+                        RegisteredCollection.session_id == session_id,
+                        RegisteredCollection.file_name == file_name
+                    )
+                )
+            )
+            registered = result.scalar_one_or_none()
+            if registered is None:
+                registered = RegisteredCollection(session_id=session_id, file_name=file_name)
+                db.add(registered)
+            registered.collection_name = collection_name
+            registered.file_hash = file_hash
+            registered.chunk_count = chunk_count
+            registered.updated_at = datetime.now()
+            await db.commit()
+        return registered
+
+    async def lookup(self, session_id: str, file_name: str)->RegisteredCollection | None:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(RegisteredCollection).where(
+                    and_(
+                        RegisteredCollection.session_id == session_id,
+                        RegisteredCollection.file_name == file_name
+                    )
+                )
+            )
+            return result.scalar_one_or_none()
+
+    async def list_session(self, session_id: str)->list[RegisteredCollection]:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(RegisteredCollection).where(RegisteredCollection.session_id == session_id).order_by(RegisteredCollection.file_name)
+            )
+            return list(result.scalars().all())
+
+    async def remove_file(self, session_id: str, file_name: str)->int:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                delete(RegisteredCollection).where(
+                    and_(
+                        RegisteredCollection.session_id == session_id,
+                        RegisteredCollection.file_name == file_name
+                    )
+                )
+            )
+            await db.commit()
+            return result.rowcount
+
+    async def remove_session(self, session_id: str)->list[str]:
+        '''drop the session's entries, return the collection names they pointed at'''
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(RegisteredCollection.collection_name).where(RegisteredCollection.session_id == session_id)
+            )
+            collection_names = list(result.scalars().all())
+            await db.execute(delete(RegisteredCollection).where(RegisteredCollection.session_id == session_id))
+            await db.commit()
+        return collection_names
+
+
+collection_registry = CollectionRegistry()
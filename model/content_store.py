@@ -0,0 +1,180 @@
+import os
+import asyncio
+import aiofiles
+from contextlib import AsyncExitStack
+from datetime import datetime
+from typing import Dict, AsyncIterator, Iterator
+from collections import Counter
+from sqlalchemy import select, and_, delete
+from model.sqlite import AsyncSessionLocal, ContentBlob, FileReference
+
+CONTENT_STORE_DIR = "content_store"
+TEXT_BLOCK_SIZE = 64 * 1024 ##chars read per block when the stored text is streamed back
+
+
+class ContentStore:
+    '''
+    content-addressed store of upload artifacts keyed by the sha256 of the raw bytes,
+    sessions link to a blob through FileReference and the blob is freed once the last reference is gone
+    '''
+    def __init__(self, store_dir: str = CONTENT_STORE_DIR):
+        self.store_dir = store_dir
+        self.locks: Dict[str, asyncio.Lock] = {} ##one ingestion per hash at a time, a concurrent repeat upload waits for it
+
+    def lock(self, file_hash: str)->asyncio.Lock:
+        return self.locks.setdefault(file_hash, asyncio.Lock())
+
+    def content_path(self, file_hash: str)->str:
+        return os.path.join(self.store_dir, f"{file_hash}.txt")
+
+    async def get_blob(self, file_hash: str)->ContentBlob | None:
+        async with AsyncSessionLocal() as db:
+            return await db.get(ContentBlob, file_hash)
+
+    async def write_text(self, file_hash: str, text_blocks: AsyncIterator[str], separator: str = "\n")->str:
+        '''
+        stream the extracted text blocks (pages, slides) to the content file of the hash without joining them in memory
+        '''
+        os.makedirs(self.store_dir, exist_ok=True)
+        content_path = self.content_path(file_hash)
+        async with aiofiles.open(content_path, "w", encoding="utf-8") as f:
+            first_block = True
+            async for block in text_blocks:
+                if not first_block:
+                    await f.write(separator)
+                await f.write(block)
+                first_block = False
+        return content_path
+
+    def iter_text(self, file_hash: str, block_size: int = TEXT_BLOCK_SIZE)->Iterator[str]:
+        '''read the content file back in blocks of block_size chars'''
+        with open(self.content_path(file_hash), "r", encoding="utf-8") as f:
+            while block := f.read(block_size):
+                yield block
+
+    def discard_text(self, file_hash: str):
+        '''drop a content file written for a blob which was never saved'''
+        content_path = self.content_path(file_hash)
+        if os.path.exists(content_path):
+            os.remove(content_path)
+
+    async def save_blob(
+            self,
+            file_hash: str,
+            num_tokens: int,
+            process_method: str,
+            collection_name: str | None = None,
+            summary: str | None = None
+        )->ContentBlob:
+        '''record the blob whose text has been written by write_text'''
+        blob = ContentBlob(
+            file_hash=file_hash,
+            content_path=self.content_path(file_hash),
+            collection_name=collection_name,
+            num_tokens=num_tokens,
+            process_method=process_method,
+            summary=summary,
+            ref_count=0,
+            created_at=datetime.now()
+        )
+        async with AsyncSessionLocal() as db:
+            blob = await db.merge(blob)
+            await db.commit()
+        return blob
+
+    async def link(self, session_id: str, file_name: str, file_hash: str)->list[str]:
+        '''
+        point (session_id, file_name) at the blob, a re-upload under the same name drops the reference to the old blob
+        return the collection names of blobs freed by this call
+        '''
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(FileReference).where(
+                    and_(
+                        FileReference.session_id == session_id,
+                        FileReference.file_name == file_name
+                    )
+                )
+            )
+            existing_reference = result.scalar_one_or_none()
+            if existing_reference and existing_reference.file_hash == file_hash:
+                return []
+            released_hashes = []
+            if existing_reference:
+                released_hashes.append(existing_reference.file_hash)
+                existing_reference.file_hash = file_hash
+                existing_reference.updated_at = datetime.now()
+            else:
+                db.add(FileReference(session_id=session_id, file_name=file_name, file_hash=file_hash, updated_at=datetime.now()))
+            blob = await db.get(ContentBlob, file_hash)
+            blob.ref_count += 1
+            released_collections = await self._decrement(db=db, file_hashes=released_hashes)
+            await db.commit()
+        return released_collections
+
+    async def resolve(self, session_id: str, file_name: str)->ContentBlob | None:
+        '''the blob a session's file name points at'''
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(ContentBlob).join(FileReference, FileReference.file_hash == ContentBlob.file_hash).where(
+                    and_(
+                        FileReference.session_id == session_id,
+                        FileReference.file_name == file_name
+                    )
+                )
+            )
+            return result.scalar_one_or_none()
+
+    async def release_file(self, session_id: str, file_name: str)->list[str]:
+        '''drop the reference of one file of the session, return the collection names of blobs no other session uses'''
+        return await self._release(FileReference.session_id == session_id, FileReference.file_name == file_name)
+
+    async def release_session(self, session_id: str)->list[str]:
+        '''drop every reference of the session, return the collection names of blobs no other session uses'''
+        return await self._release(FileReference.session_id == session_id)
+
+    async def _release(self, *conditions)->list[str]:
+        '''
+        drop the references matching conditions, the blobs are decremented under their hash locks
+        so a concurrent link never finds its blob deleted under it
+        '''
+        while True:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(select(FileReference.file_hash).where(and_(*conditions)))
+                file_hashes = set(result.scalars().all())
+            if not file_hashes:
+                return []
+            async with AsyncExitStack() as stack:
+                ##sorted so two releases never wait on each other's locks
+                for file_hash in sorted(file_hashes):
+                    await stack.enter_async_context(self.lock(file_hash))
+                async with AsyncSessionLocal() as db:
+                    result = await db.execute(select(FileReference).where(and_(*conditions)))
+                    references = result.scalars().all()
+                    if {each.file_hash for each in references} - file_hashes:
+                        continue ##a reference was pointed at another blob meanwhile
+                    await db.execute(delete(FileReference).where(and_(*conditions)))
+                    released_collections = await self._decrement(db=db, file_hashes=[each.file_hash for each in references])
+                    await db.commit()
+            return released_collections
+
+    async def _decrement(self, db, file_hashes: list[str])->list[str]:
+        '''decrement the blobs once per reference, delete the ones reaching zero'''
+        released_collections = []
+        for file_hash, reference_count in Counter(file_hashes).items():
+            blob = await db.get(ContentBlob, file_hash)
+            if blob is None:
+                continue
+            blob.ref_count -= reference_count
+            if blob.ref_count <= 0:
+                if blob.collection_name:
+                    released_collections.append(blob.collection_name)
+                if os.path.exists(blob.content_path):
+                    os.remove(blob.content_path)
+                await db.delete(blob)
+                if file_hash in self.locks and not self.locks[file_hash].locked():
+                    del self.locks[file_hash]
+        return released_collections
+
+
+content_store = ContentStore()
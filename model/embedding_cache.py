@@ -0,0 +1,141 @@
+import os
+import sqlite3
+import hashlib
+import threading
+from typing import Callable
+import numpy as np
+from time import time
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBEDDING_CACHE_PATH = os.getenv("embedding_cache_path", "sqlite/app/embedding_cache.db")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("embedding_cache_max_entries", 500_000))
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2" ##chromadb default embedding model
+SQLITE_MAX_PARAMS = 900 ##stay under the sqlite bound variable limit of older builds
+
+
+class EmbeddingCache:
+    '''
+    disk-backed float32 embedding store keyed by sha256(model, text),
+    least recently used entries are evicted once the cache holds more than max_entries vectors
+    '''
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES, model_name: str = EMBEDDING_MODEL_NAME):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.lock = threading.Lock() ##embedding functions are called from worker threads
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_embedding_cache_last_used ON embedding_cache (last_used)")
+        self.conn.commit()
+        self.entry_count = self.conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, text: str)->str:
+        return hashlib.sha256(f"{self.model_name}\x00{text}".encode("utf-8", errors="surrogatepass")).hexdigest()
+
+    def get_many(self, texts: list[str])->list[np.ndarray | None]:
+        '''cached vectors in the order of texts, None for a miss'''
+        keys = [self.key(text) for text in texts]
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), SQLITE_MAX_PARAMS):
+                batch = keys[start: start + SQLITE_MAX_PARAMS]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(f"SELECT key, vector FROM embedding_cache WHERE key IN ({placeholders})", batch).fetchall()
+                found.update({key: np.frombuffer(vector, dtype=np.float32) for key, vector in rows})
+                ##refresh recency of the hits
+                hit_keys = [key for key, _ in rows]
+                if hit_keys:
+                    self.conn.execute(
+                        f"UPDATE embedding_cache SET last_used = ? WHERE key IN ({','.join('?' * len(hit_keys))})",
+                        [time(), *hit_keys]
+                    )
+            self.conn.commit()
+            results = [found.get(key) for key in keys]
+            self.hits += sum(1 for each in results if each is not None)
+            self.misses += sum(1 for each in results if each is None)
+        return results
+
+    def put_many(self, texts: list[str], vectors: list)->None:
+        now = time()
+        rows = [(self.key(text), np.asarray(vector, dtype=np.float32).tobytes(), now) for text, vector in zip(texts, vectors)]
+        with self.lock:
+            changes_before = self.conn.total_changes
+            self.conn.executemany("INSERT OR IGNORE INTO embedding_cache (key, vector, last_used) VALUES (?, ?, ?)", rows)
+            self.entry_count += self.conn.total_changes - changes_before
+            overflow = self.entry_count - self.max_entries
+            if overflow > 0:
+                ##evict a little more than needed so eviction does not run on every insert
+                evict_count = overflow + max(1, self.max_entries // 100)
+                self.conn.execute(
+                    "DELETE FROM embedding_cache WHERE key IN (SELECT key FROM embedding_cache ORDER BY last_used ASC LIMIT ?)",
+                    (evict_count,)
+                )
+                evicted = self.conn.execute("SELECT changes()").fetchone()[0]
+                self.entry_count -= evicted
+                self.evictions += evicted
+            self.conn.commit()
+
+    def stats(self)->dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": self.entry_count,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    '''
+    chromadb embedding function which only computes the texts missing from the cache, in one batch per call
+    '''
+    def __init__(self, cache: EmbeddingCache, embedding_function: Callable[[list[str]], Embeddings] | None = None):
+        self.cache = cache
+        self.embedding_function = embedding_function or DefaultEmbeddingFunction()
+
+    @staticmethod
+    def name()->str:
+        ##persisted in the configuration of the collections created with it
+        return "cached_all_minilm_l6_v2"
+
+    def get_config(self)->dict:
+        return {"model_name": self.cache.model_name}
+
+    @staticmethod
+    def build_from_config(config: dict)->"CachedEmbeddingFunction":
+        '''collections opened without an embedding function share the process' cached function'''
+        from model.embedding_service import cached_embedding_function
+        if config.get("model_name") != cached_embedding_function.cache.model_name:
+            raise ValueError(f"collection was embedded with {config.get('model_name')}, the cache holds {cached_embedding_function.cache.model_name}")
+        return cached_embedding_function
+
+    def __call__(self, input: Documents)->Embeddings:
+        vectors = self.cache.get_many(list(input))
+        ##identical texts within the batch are embedded once
+        missing_texts = list(dict.fromkeys(text for text, vector in zip(input, vectors) if vector is None))
+        if missing_texts:
+            computed = self.embedding_function(missing_texts)
+            self.cache.put_many(missing_texts, computed)
+            computed_vectors = {text: np.asarray(vector, dtype=np.float32) for text, vector in zip(missing_texts, computed)}
+            vectors = [vector if vector is not None else computed_vectors[text] for text, vector in zip(input, vectors)]
+        return vectors
+
+
+embedding_cache = EmbeddingCache()
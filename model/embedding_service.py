@@ -0,0 +1,163 @@
+import os
+import asyncio
+import threading
+import numpy as np
+import onnxruntime
+from tokenizers import Tokenizer
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from chromadb.api.models.Collection import Collection
+from chromadb.api.types import Documents, Embeddings, EmbeddingFunction
+from chromadb.utils.embedding_functions import DefaultEmbeddingFunction, ONNXMiniLM_L6_V2
+from dotenv import load_dotenv
+from model.embedding_cache import CachedEmbeddingFunction, embedding_cache
+
+load_dotenv()
+
+EMBEDDING_BATCH_SIZE = int(os.getenv("embedding_batch_size", 64))
+EMBEDDING_WORKERS = int(os.getenv("embedding_workers", 1)) ##threads of the dedicated embedding executor
+EMBEDDING_INTRA_OP_THREADS = int(os.getenv("embedding_intra_op_threads", 0)) ##onnxruntime threads per batch, 0 keeps the runtime default
+
+
+class ThreadLimitedMiniLM(EmbeddingFunction[Documents]):
+    '''
+    the chromadb default model (all-MiniLM-L6-v2 onnx files) run by an onnxruntime session built here
+    with a fixed intra-op thread count, so one large batch cannot take every core of the server
+    '''
+    MAX_TOKENS = 256 ##sequence length the chromadb default function truncates to
+    MODEL_DIR = os.path.join(ONNXMiniLM_L6_V2.DOWNLOAD_PATH, ONNXMiniLM_L6_V2.EXTRACTED_FOLDER_NAME)
+
+    def __init__(self, intra_op_threads: int):
+        self.intra_op_threads = intra_op_threads
+        self.session = None
+        self.tokenizer = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.session is not None:
+                return
+            if not os.path.exists(os.path.join(self.MODEL_DIR, "model.onnx")):
+                ##the chromadb default function downloads and verifies the model files on first use
+                DefaultEmbeddingFunction()(["warm up"])
+            session_options = onnxruntime.SessionOptions()
+            session_options.log_severity_level = 3
+            session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            session_options.intra_op_num_threads = self.intra_op_threads
+            session_options.inter_op_num_threads = 1
+            tokenizer = Tokenizer.from_file(os.path.join(self.MODEL_DIR, "tokenizer.json"))
+            tokenizer.enable_truncation(max_length=self.MAX_TOKENS)
+            tokenizer.enable_padding(pad_id=0, pad_token="[PAD]") ##to the longest text of the batch
+            self.tokenizer = tokenizer
+            self.session = onnxruntime.InferenceSession(
+                os.path.join(self.MODEL_DIR, "model.onnx"),
+                sess_options=session_options,
+                providers=["CPUExecutionProvider"]
+            )
+
+    def __call__(self, input: Documents)->Embeddings:
+        self.load()
+        encoded = self.tokenizer.encode_batch(list(input))
+        input_ids = np.array([each.ids for each in encoded], dtype=np.int64)
+        attention_mask = np.array([each.attention_mask for each in encoded], dtype=np.int64)
+        last_hidden_state = self.session.run(None, {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": np.zeros_like(input_ids)
+        })[0]
+        ##mean pooling over the real tokens, then unit length like the chromadb default function
+        mask = attention_mask[:, :, None].astype(np.float32)
+        embeddings = (last_hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1e-12
+        return [each.astype(np.float32) for each in embeddings / norms]
+
+
+def build_embedding_function(intra_op_threads: int = EMBEDDING_INTRA_OP_THREADS)->EmbeddingFunction:
+    if intra_op_threads > 0:
+        return ThreadLimitedMiniLM(intra_op_threads=intra_op_threads)
+    return DefaultEmbeddingFunction()
+
+
+class EmbeddingService:
+    '''
+    embeds and writes chunks to chromadb batch by batch on a dedicated bounded executor,
+    so indexing a large document neither blocks the shared thread pool nor holds every embedding in memory,
+    texts are looked up in the embedding cache first and only the misses reach the model
+    '''
+    def __init__(self, model_function: EmbeddingFunction, batch_size: int = EMBEDDING_BATCH_SIZE, max_workers: int = EMBEDDING_WORKERS):
+        self.model_function = model_function
+        self.embedding_function = CachedEmbeddingFunction(cache=embedding_cache, embedding_function=self.embed_with_model)
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="embedding")
+        self.embedded_chunks = 0
+        self.embedding_seconds = 0.0
+        self.last_chunks_per_sec = 0.0
+
+    def embed_with_model(self, texts: list[str])->list:
+        '''the throughput counters only see the texts the model actually embeds'''
+        start = perf_counter()
+        embeddings = self.model_function(texts)
+        elapsed = perf_counter() - start
+        self.embedded_chunks += len(texts)
+        self.embedding_seconds += elapsed
+        self.last_chunks_per_sec = len(texts) / elapsed if elapsed > 0 else 0.0
+        return embeddings
+
+    def embed_batch(self, texts: list[str])->list:
+        return self.embedding_function(texts)
+
+    async def embed(self, texts: list[str])->list:
+        loop = asyncio.get_running_loop()
+        embeddings = []
+        for start in range(0, len(texts), self.batch_size):
+            embeddings += await loop.run_in_executor(self.executor, self.embed_batch, texts[start: start + self.batch_size])
+        return embeddings
+
+    def _add_batch(self, collection: Collection, ids: list[str], documents: list[str], metadatas: list[dict], embeddings: list | None):
+        if embeddings is None:
+            embeddings = self.embed_batch(documents)
+        collection.add(ids=ids, documents=documents, metadatas=metadatas, embeddings=embeddings)
+
+    async def add_to_collection(
+            self,
+            collection: Collection,
+            ids: list[str],
+            documents: list[str],
+            metadatas: list[dict],
+            embeddings: list | None = None
+        )->int:
+        '''
+        write the chunks to the collection in batch_size batches, embedding each batch right before it is added
+        unless the embeddings are given
+        '''
+        loop = asyncio.get_running_loop()
+        for start in range(0, len(ids), self.batch_size):
+            end = start + self.batch_size
+            await loop.run_in_executor(
+                self.executor,
+                self._add_batch,
+                collection,
+                ids[start: end],
+                documents[start: end],
+                metadatas[start: end],
+                embeddings[start: end] if embeddings is not None else None
+            )
+        return len(ids)
+
+    def stats(self)->dict:
+        return {
+            "batch_size": self.batch_size,
+            "embedded_chunks": self.embedded_chunks,
+            "embedding_seconds": round(self.embedding_seconds, 3),
+            "chunks_per_sec": self.embedded_chunks / self.embedding_seconds if self.embedding_seconds else 0.0,
+            "last_batch_chunks_per_sec": self.last_chunks_per_sec
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+embedding_service = EmbeddingService(model_function=build_embedding_function())
+##embeddings are looked up in the local cache first, only misses go through the model
+cached_embedding_function = embedding_service.embedding_function
@@ -2,10 +2,17 @@ import chromadb
 import pdfplumber
 from fastapi import UploadFile
 from io import BytesIO
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 import hashlib
-from typing import Dict
+import asyncio
+from typing import Dict, Iterable
 from chromadb.config import Settings
+from chromadb.api.models.Collection import Collection
+from collections import defaultdict
+from model.embedding_service import cached_embedding_function, embedding_service
+from model.bm25_index import Bm25IndexBuilder, bm25_index_store
+from model.retrieval_cache import retrieval_cache
+from model.query_cache import query_cache
+from utils.streaming_splitter import iter_chunks
 from openai import AsyncOpenAI
 import os
 import warnings
@@ -14,6 +21,57 @@ import warnings
 warnings.filterwarnings("ignore", message="Failed to send telemetry event")
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+##"collection_per_file" keeps one chromadb collection per content hash,
+##"shared" stores every content collection in one physical collection filtered by a scope metadata field
+CHROMA_LAYOUT = os.getenv("chroma_layout", "collection_per_file")
+SHARED_COLLECTION_NAME = "shared_content"
+CONTENT_COLLECTION_PREFIX = "content_"
+
+
+class ScopedCollection():
+    '''
+    a logical collection inside the shared physical collection, exposing the Collection calls used for indexing and search,
+    ids are prefixed with the scope on the way in and stripped on the way out so chunk ids stay unique across files
+    '''
+    def __init__(self, collection: Collection, scope: str):
+        self.collection = collection
+        self.name = scope
+        self.where = {"scope": scope}
+
+    def _scoped_ids(self, ids: list[str] | None)->list[str] | None:
+        return [f"{self.name}:{each}" for each in ids] if ids is not None else None
+
+    def _scoped_metadatas(self, metadatas: list[dict] | None)->list[dict] | None:
+        return [{**each, "scope": self.name} for each in metadatas] if metadatas is not None else None
+
+    def _strip_ids(self, ids: list[str])->list[str]:
+        return [each[len(self.name) + 1:] for each in ids]
+
+    def get(self, ids: list[str] | None = None, include: list[str] | None = None, where: dict | None = None):
+        scoped_where = {"$and": [self.where, where]} if where else self.where
+        result = self.collection.get(ids=self._scoped_ids(ids), where=scoped_where, include=include if include is not None else ["documents", "metadatas"])
+        result["ids"] = self._strip_ids(result["ids"])
+        return result
+
+    def query(self, query_texts: list[str], n_results: int, include: list[str]):
+        result = self.collection.query(query_texts=query_texts, n_results=n_results, where=self.where, include=include)
+        result["ids"] = [self._strip_ids(each) for each in result["ids"]]
+        return result
+
+    def add(self, ids: list[str], documents: list[str], metadatas: list[dict], embeddings: list | None = None):
+        self.collection.add(ids=self._scoped_ids(ids), documents=documents, metadatas=self._scoped_metadatas(metadatas), embeddings=embeddings)
+
+    def update(self, ids: list[str], metadatas: list[dict]):
+        self.collection.update(ids=self._scoped_ids(ids), metadatas=self._scoped_metadatas(metadatas))
+
+    def delete(self, ids: list[str] | None = None):
+        '''without ids every chunk of the scope is deleted'''
+        if ids is None:
+            self.collection.delete(where=self.where)
+        else:
+            self.collection.delete(ids=self._scoped_ids(ids))
+
+
 class Chromadb_agent():
     chromadb_client = None,
 
@@ -22,65 +80,235 @@ class Chromadb_agent():
             path="./chromadb_data",
             settings=Settings(anonymized_telemetry=False)
         )
+        ##embeddings are looked up in the local cache first, only misses go through the model
+        self.embedding_function = cached_embedding_function
+
+    @staticmethod
+    def is_shared(collection_name: str)->bool:
+        return CHROMA_LAYOUT == "shared" and collection_name.startswith(CONTENT_COLLECTION_PREFIX)
+
+    def get_collection(self, collection_name: str)->Collection | ScopedCollection:
+        if Chromadb_agent.is_shared(collection_name):
+            return ScopedCollection(self.get_or_create_collection(SHARED_COLLECTION_NAME), scope=collection_name)
+        return self.open_collection(self.chromadb_client.get_collection, collection_name)
+
+    def get_or_create_collection(self, collection_name: str)->Collection | ScopedCollection:
+        if Chromadb_agent.is_shared(collection_name):
+            return ScopedCollection(self.get_or_create_collection(SHARED_COLLECTION_NAME), scope=collection_name)
+        return self.open_collection(self.chromadb_client.get_or_create_collection, collection_name)
+
+    def open_collection(self, open_function, collection_name: str)->Collection:
+        '''
+        open the physical collection with the cached embedding function,
+        collections created before it existed persisted chromadb's "default" function (the same all-MiniLM-L6-v2 model)
+        and are opened with their persisted function instead
+        '''
+        try:
+            return open_function(name=collection_name, embedding_function=self.embedding_function)
+        except ValueError as e:
+            if "Embedding function conflict" not in str(e):
+                raise
+            return open_function(name=collection_name)
         
-    async def index_file(self, session_id: str, filename: str, text: str)->Dict[str, str]:
-        normalized_collection_name = Chromadb_agent.collection_name_normalize(session_id=session_id, filename=filename)
-        ##if found the same file in chromadb remove it.
-        existing_collections_name =  [each.name for each in self.chromadb_client.list_collections()]
-        if normalized_collection_name in existing_collections_name:
-            self.chromadb_client.delete_collection(normalized_collection_name)
-        text_spliter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200, length_function=len, separators=["\n\n", "\n", ". ", " ", ""])
-        chunks = text_spliter.split_text(text)
-        formated_chunks = [{"chunk_id": i, "content": chunk, "word_count": len(chunk.split()), "char_count": len(chunk)} for i, chunk in enumerate(chunks)]
-        collection = self.chromadb_client.get_or_create_collection(name=normalized_collection_name)
-        documents, metadata, ids = [], [], []
-        file_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
-
-        for chunk_info in formated_chunks:
-            documents.append(chunk_info["content"])
-            metadata.append({
-                "filename": filename,
-                "chunk_id": chunk_info["chunk_id"],
-                "word_count": chunk_info["word_count"],
-                "char_count": chunk_info["char_count"],
-                "file_hash": file_hash,
-                "session_id": session_id
-            })
-            ids.append(f"{filename}_{file_hash}_{chunk_info['chunk_id']}")
-        
-        collection.add(ids=ids, documents=documents, metadatas=metadata)
+    async def index_file(
+            self,
+            session_id: str,
+            filename: str,
+            text_blocks: Iterable[str],
+            file_hash: str,
+            collection_name: str | None = None,
+            base_collection_name: str | None = None
+        )->Dict[str, str | int]:
+        '''
+        sync collection_name (defaults to the per session collection of the file) to the chunks of the text by chunk content hash,
+        the text is streamed in blocks through the chunker and written batch by batch so the whole document is never held in memory,
+        only chunks missing from it are embedded, chunks found in base_collection_name (e.g. the previous version of the file)
+        are copied with their stored embeddings and chunks no longer in the text are removed
+        '''
+        normalized_collection_name = collection_name or Chromadb_agent.collection_name_normalize(session_id=session_id, filename=filename)
+        ##every chromadb call, the reads of the text blocks, the chunking and the hashing run off the event loop
+        collection = await asyncio.to_thread(self.get_or_create_collection, normalized_collection_name)
+        ##only the ids are held to diff against the collection and the previous version
+        existing_ids = set((await asyncio.to_thread(collection.get, include=[]))["ids"])
+        base_collection = await asyncio.to_thread(self.get_collection_or_none, base_collection_name) if base_collection_name else None
+        base_ids = set((await asyncio.to_thread(base_collection.get, include=[]))["ids"]) if base_collection else set()
+        seen_ids = set()
+        occurrences = defaultdict(int)
+        counts = {"total_chunks": 0, "total_characters": 0, "added": 0, "kept": 0}
+        bm25_builder = Bm25IndexBuilder()
+
+        def counted_blocks():
+            for block in text_blocks:
+                counts["total_characters"] += len(block)
+                yield block
+
+        def chunk_batches():
+            '''resumed in a worker thread for one batch at a time'''
+            batch = []
+            for chunk_position, chunk in enumerate(iter_chunks(counted_blocks())):
+                chunk_id = Chromadb_agent.chunk_id(chunk=chunk, occurrences=occurrences)
+                seen_ids.add(chunk_id)
+                batch.append((chunk_id, {
+                    "filename": filename,
+                    "chunk_id": chunk_position,
+                    "word_count": len(chunk.split()),
+                    "char_count": len(chunk),
+                    "file_hash": file_hash[:16],
+                    "session_id": session_id
+                }, chunk))
+                counts["total_chunks"] += 1
+                if len(batch) >= embedding_service.batch_size:
+                    bm25_builder.add(chunk_ids=[each[0] for each in batch], chunks=[each[2] for each in batch])
+                    yield batch
+                    batch = []
+            if batch:
+                bm25_builder.add(chunk_ids=[each[0] for each in batch], chunks=[each[2] for each in batch])
+                yield batch
+
+        batches = chunk_batches()
+        while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+            await self._sync_chunk_batch(collection, batch, existing_ids, base_collection, base_ids, counts)
+
+        ##chunks gone from the text
+        stale_ids = list(existing_ids - seen_ids)
+        for start in range(0, len(stale_ids), embedding_service.batch_size):
+            await asyncio.to_thread(collection.delete, ids=stale_ids[start: start + embedding_service.batch_size])
+        ##the keyword index is built once here and saved next to the collection instead of on every search
+        await asyncio.to_thread(bm25_index_store.save, normalized_collection_name, bm25_builder)
+        retrieval_cache.invalidate(normalized_collection_name)
+        query_cache.invalidate(normalized_collection_name)
         ##distance below 1.7 is relevant
 
         return {
             "filename": filename,
-            "total_chunks": len(chunks),
-            "total_characters": len(text),
+            "total_chunks": counts["total_chunks"],
+            "total_characters": counts["total_characters"],
             "collection_name": normalized_collection_name,
-            "chunks_stored": len(formated_chunks)
+            "chunks_stored": counts["total_chunks"],
+            "added": counts["added"],
+            "kept": counts["kept"],
+            "removed": len(stale_ids) + len(base_ids - seen_ids - existing_ids)
         }
+
+    async def _sync_chunk_batch(
+            self,
+            collection: Collection,
+            batch: list[tuple[str, dict, str]],
+            existing_ids: set[str],
+            base_collection: Collection | None,
+            base_ids: set[str],
+            counts: Dict[str, int]
+        ):
+        '''
+        write one batch of (chunk id, metadata, chunk) to the collection
+        '''
+        ##unchanged chunks only need their position and file hash refreshed
+        kept = [each for each in batch if each[0] in existing_ids]
+        if kept:
+            await asyncio.to_thread(collection.update, ids=[each[0] for each in kept], metadatas=[each[1] for each in kept])
+        missing = [each for each in batch if each[0] not in existing_ids]
+        ##chunks of the previous version are copied with their embeddings instead of embedding them again
+        base_embeddings = {}
+        candidate_ids = [each[0] for each in missing if each[0] in base_ids]
+        if base_collection and candidate_ids:
+            base_chunks = await asyncio.to_thread(base_collection.get, ids=candidate_ids, include=["embeddings"])
+            base_embeddings = dict(zip(base_chunks["ids"], base_chunks["embeddings"]))
+            copied = [each for each in missing if each[0] in base_embeddings]
+            await embedding_service.add_to_collection(
+                collection=collection,
+                ids=[each[0] for each in copied],
+                documents=[each[2] for each in copied],
+                metadatas=[each[1] for each in copied],
+                embeddings=[base_embeddings[each[0]] for each in copied]
+            )
+            counts["kept"] += len(copied)
+        counts["kept"] += len(kept)
+        ##the remaining chunks are embedded and added
+        embedded = [each for each in missing if each[0] not in base_embeddings]
+        if embedded:
+            await embedding_service.add_to_collection(
+                collection=collection,
+                ids=[each[0] for each in embedded],
+                documents=[each[2] for each in embedded],
+                metadatas=[each[1] for each in embedded]
+            )
+            counts["added"] += len(embedded)
+
+    def get_collection_or_none(self, collection_name: str)->Collection | None:
+        try:
+            return self.get_collection(collection_name)
+        except Exception:
+            return None
+
+    @staticmethod
+    def chunk_id(chunk: str, occurrences: defaultdict)->str:
+        '''
+        content addressed chunk id, the occurrence suffix keeps repeated chunks (e.g. page headers) apart
+        '''
+        chunk_hash = hashlib.sha256(chunk.encode("utf-8")).hexdigest()[:24]
+        chunk_hash_id = f"{chunk_hash}_{occurrences[chunk_hash]}"
+        occurrences[chunk_hash] += 1
+        return chunk_hash_id
+
+    @staticmethod
+    def chunk_ids(chunks: Iterable[str])->list[str]:
+        occurrences = defaultdict(int)
+        return [Chromadb_agent.chunk_id(chunk=chunk, occurrences=occurrences) for chunk in chunks]
     
     def remove_collection_by_filename(self, session_id: str, filename: str)->tuple[str, bool]:
         try:
             self.chromadb_client.delete_collection(f"{session_id}_{filename}")
+            bm25_index_store.invalidate(f"{session_id}_{filename}")
+            retrieval_cache.invalidate(f"{session_id}_{filename}")
+            query_cache.invalidate(f"{session_id}_{filename}")
             return (f"the collection of file {filename} in Session {session_id} has been removed", True)
         except Exception as e:
             return (e, False)
     
-    def remove_collection_by_session_id(self, session_id: str)->tuple[str, bool]:
+    def remove_collection(self, collection_name: str)->tuple[str, bool]:
         try:
-            collections = self.chromadb_client.list_collections()
-            collection_names = list(map(lambda x: x.name, collections))
-            matched_collections = [name for name in collection_names if name.startswith(session_id)]
-            ##remove the collections which matches session_id
-            if matched_collections:
-                for each in matched_collections:
-                    self.chromadb_client.delete_collection(each)
+            if Chromadb_agent.is_shared(collection_name):
+                self.get_collection(collection_name).delete()
             else:
-                return (f"Session_id {session_id} does not exist", False)
-            return (f"Documents associated session_id {session_id} have been removed", True)
+                self.chromadb_client.delete_collection(collection_name)
+            bm25_index_store.invalidate(collection_name)
+            retrieval_cache.invalidate(collection_name)
+            query_cache.invalidate(collection_name)
+            return (f"the collection {collection_name} has been removed", True)
         except Exception as e:
             return (e, False)
+
+    def remove_collection_by_session_id(
+            self,
+            session_id: str,
+            registered_collections: list[str],
+            released_collections: list[str] | None = None,
+            file_names: list[str] | None = None
+        )->tuple[str, bool]:
+        '''
+        registered_collections are the collections the session's registry entries pointed at,
+        the content collections among them are only removed when in released_collections (no other session references them),
+        per session collections (the registered ones and the {session}_{file} collections of file_names indexed before the registry existed)
+        belong to this session alone and are always removed
+        '''
+        if not registered_collections and not released_collections and not file_names:
+            return (f"Session_id {session_id} does not exist", False)
+        for each in released_collections or []:
+            self.remove_collection(collection_name=each)
+        legacy_collections = {each for each in registered_collections if not each.startswith(CONTENT_COLLECTION_PREFIX)}
+        legacy_collections.update(Chromadb_agent.collection_name_normalize(session_id=session_id, filename=each) for each in file_names or [])
+        ##a file which never got a collection only fails its removal
+        for each in legacy_collections - set(released_collections or []):
+            self.remove_collection(collection_name=each)
+        return (f"Documents associated session_id {session_id} have been removed", True)
         
+    @staticmethod
+    def content_collection_name(file_hash: str)->str:
+        '''
+        collection shared by every session which uploaded the same bytes
+        '''
+        return f"{CONTENT_COLLECTION_PREFIX}{file_hash[:32]}"
+
     @staticmethod
     def collection_name_normalize(session_id: str, filename: str)->str:
         '''
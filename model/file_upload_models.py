@@ -6,4 +6,7 @@ class UploadedFile(BaseModel):
     file_name: str = Field(..., description="the name of the file")
     estimated_tokens: int = Field(default=0, description="number of the tokens")
     process_method: Literal["file_search", "coding"]
-    result: bool = Field(..., description="if indexed successfully")
\ No newline at end of file
+    result: bool = Field(..., description="if indexed successfully")
+    file_hash: str | None = Field(default=None, description="sha256 of the raw uploaded bytes")
+    file_size: int = Field(default=0, description="number of bytes written to disk")
+    error: str | None = Field(default=None, description="reason of the upload being rejected")
\ No newline at end of file
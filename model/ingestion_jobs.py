@@ -0,0 +1,159 @@
+import os
+import asyncio
+import uuid
+from time import time
+from typing import Dict, List, Literal, Callable, Awaitable
+from pydantic import BaseModel, Field
+from dotenv import load_dotenv
+from model.session_manager import manager
+from model.file_upload_models import UploadedFile
+
+load_dotenv()
+
+INGESTION_WORKER_COUNT = int(os.getenv("ingestion_worker_count", 2))
+JOB_RETENTION_SECONDS = int(os.getenv("ingestion_job_retention_seconds", 3600))
+
+class IngestionCancelledError(Exception):
+    '''raised by the progress report of a job whose session has been deleted, so the job stops at its next stage'''
+
+
+IngestionStage = Literal["queued", "extracting", "counting", "indexing", "summarizing", "completed", "failed"]
+
+
+class IngestionJob(BaseModel):
+    job_id: str = Field(..., description="the id returned to the client on upload")
+    session_id: str
+    file_name: str
+    file_path: str = Field(..., description="where the upload has been streamed to")
+    file_hash: str | None = Field(default=None, description="sha256 of the raw uploaded bytes")
+    file_size: int = 0
+    stage: IngestionStage = "queued"
+    progress: float = Field(default=0.0, description="0.0 to 1.0")
+    result: UploadedFile | None = None
+    index_result: dict | None = Field(default=None, description="chunk counts reported by the indexing stage (added, kept, removed)")
+    error: str | None = None
+    cancelled: bool = Field(default=False, description="set when the session is deleted while the job is queued or running")
+    created_at: float
+    updated_at: float
+
+
+ProgressReporter = Callable[[IngestionJob, IngestionStage, float], Awaitable[None]]
+IngestionHandler = Callable[[IngestionJob, ProgressReporter], Awaitable[UploadedFile]]
+
+
+class IngestionJobManager:
+    '''
+    in-process job queue for file ingestion (extract -> count -> index -> summarize),
+    a fixed number of workers drain the queue so uploads return as soon as the bytes are on disk
+    '''
+    def __init__(self, worker_count: int = INGESTION_WORKER_COUNT):
+        self.worker_count = worker_count
+        self.jobs: Dict[str, IngestionJob] = {}
+        self.finished_uploads: Dict[str, List[UploadedFile]] = {} ##session_id -> ingested files not yet seen by the supervisor
+        self.queue: asyncio.Queue | None = None
+        self.workers: List[asyncio.Task] = []
+        self.handler: IngestionHandler | None = None
+
+    async def start(self, handler: IngestionHandler):
+        '''start the worker pool, handler runs the ingestion pipeline of a single job'''
+        if self.workers:
+            return
+        self.handler = handler
+        self.queue = asyncio.Queue()
+        self.workers = [asyncio.create_task(self._worker(worker_id)) for worker_id in range(self.worker_count)]
+        print(f"ingestion workers started: {self.worker_count}")
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, session_id: str, uploaded_file: UploadedFile, file_path: str)->IngestionJob:
+        if self.queue is None:
+            raise Exception("ingestion workers are not started")
+        self._prune_finished_jobs()
+        now = time()
+        job = IngestionJob(
+            job_id=f"job_{uuid.uuid4().hex[:12]}",
+            session_id=session_id,
+            file_name=uploaded_file.file_name,
+            file_path=file_path,
+            file_hash=uploaded_file.file_hash,
+            file_size=uploaded_file.file_size,
+            created_at=now,
+            updated_at=now
+        )
+        self.jobs[job.job_id] = job
+        self.queue.put_nowait(job.job_id)
+        return job
+
+    def get_job(self, job_id: str)->IngestionJob | None:
+        return self.jobs.get(job_id)
+
+    def pop_finished_uploads(self, session_id: str)->List[UploadedFile]:
+        '''return the files whose ingestion has finished since the last call, only getting once'''
+        return self.finished_uploads.pop(session_id, [])
+
+    def remove_session(self, session_id: str):
+        '''
+        drop the session's jobs, queued ones are skipped and running ones are flagged
+        so they stop at their next stage and undo what they already linked to the session
+        '''
+        self.finished_uploads.pop(session_id, None)
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.session_id == session_id]:
+            self.jobs.pop(job_id).cancelled = True
+
+    async def report_progress(self, job: IngestionJob, stage: IngestionStage, progress: float):
+        if job.cancelled and stage not in ("completed", "failed"):
+            raise IngestionCancelledError(f"session {job.session_id} was deleted while {job.file_name} was ingested")
+        job.stage = stage
+        job.progress = progress
+        job.updated_at = time()
+        await manager.send_event(thread_id=job.session_id, event={
+            "type": "ingestion_progress",
+            "sender": "ingestion_worker",
+            "content": f"{job.file_name}: {stage}",
+            "job_id": job.job_id,
+            "file_name": job.file_name,
+            "stage": stage,
+            "progress": progress,
+            "error": job.error
+        })
+
+    async def _worker(self, worker_id: int):
+        while True:
+            job_id = await self.queue.get()
+            job = self.jobs.get(job_id)
+            try:
+                if job is None: ##session removed while the job was queued
+                    continue
+                job.result = await self.handler(job, self.report_progress)
+                if job.cancelled: ##the session is gone, nothing is reported to it
+                    continue
+                self.finished_uploads.setdefault(job.session_id, []).append(job.result)
+                ##the handler falls back to the coding app on errors and keeps the error on the job
+                if job.error:
+                    await self.report_progress(job, "failed", job.progress)
+                else:
+                    await self.report_progress(job, "completed", 1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.error = str(e)
+                await self.report_progress(job, "failed", job.progress)
+                print(f"ingestion worker {worker_id} failed on {job.file_name}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def _prune_finished_jobs(self):
+        expire_before = time() - JOB_RETENTION_SECONDS
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.stage in ("completed", "failed") and job.updated_at < expire_before
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+
+ingestion_manager = IngestionJobManager()
@@ -0,0 +1,80 @@
+import os
+import threading
+from time import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("query_cache_max_entries", 1024))
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("query_cache_ttl_seconds", 1800))
+
+
+def normalize_queries(queries: list[str])->tuple[str, ...]:
+    '''the same queries in another order, case or spacing share one cache entry'''
+    return tuple(sorted({" ".join(query.lower().split()) for query in queries if query.strip()}))
+
+
+class QueryResultCache:
+    '''
+    fused retrieval results keyed by (collection name, file_hash, normalized query set),
+    entries expire after ttl_seconds, the least recently used go once max_entries is reached
+    and every entry of a collection is dropped when it is rebuilt or removed
+    '''
+    def __init__(self, max_entries: int = QUERY_CACHE_MAX_ENTRIES, ttl_seconds: float = QUERY_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict[tuple, tuple[float, list]] = OrderedDict() ##key -> (expires at, fused results)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(collection_name: str, file_hash: str | None, queries: list[str])->tuple:
+        return (collection_name, file_hash, normalize_queries(queries))
+
+    def get(self, collection_name: str, file_hash: str | None, queries: list[str])->list | None:
+        key = QueryResultCache.key(collection_name, file_hash, queries)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None: ##expired
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, collection_name: str, file_hash: str | None, queries: list[str], results: list):
+        key = QueryResultCache.key(collection_name, file_hash, queries)
+        with self.lock:
+            self.entries[key] = (time() + self.ttl_seconds, results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, collection_name: str):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == collection_name]:
+                del self.entries[key]
+                self.invalidations += 1
+
+    def stats(self)->dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+
+query_cache = QueryResultCache()
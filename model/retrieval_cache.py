@@ -0,0 +1,97 @@
+import os
+import threading
+from collections import OrderedDict
+from chromadb.api.models.Collection import Collection
+from dotenv import load_dotenv
+from model.bm25_index import bm25_index_store, bm25_size_bytes
+
+load_dotenv()
+
+RETRIEVAL_CACHE_MAX_BYTES = int(os.getenv("retrieval_cache_max_bytes", 256 * 1024 * 1024))
+COLLECTION_HANDLE_BYTES = 16 * 1024 ##nominal size of a collection handle, the vectors stay in chromadb
+
+
+class RetrievalCache:
+    '''
+    warm retrieval state per (collection name, file_hash): the chromadb collection handle in the server process
+    and the loaded bm25 retriever in the retrieval workers, least recently used entries are evicted once the approximate size of the cached state crosses max_bytes
+    '''
+    def __init__(self, max_bytes: int = RETRIEVAL_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple[str, str | None], dict] = OrderedDict() ##key -> {"collection", "bm25", "size"}
+        self.total_bytes = 0
+        self.lock = threading.Lock() ##retrievers are used from worker threads
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.versions: dict[str, int] = {} ##collection name -> number of invalidations, lets worker processes drop stale state
+
+    def version(self, collection_name: str)->int:
+        return self.versions.get(collection_name, 0)
+
+    def get_collection(self, chromadb_agent, collection_name: str, file_hash: str | None = None)->Collection:
+        key = (collection_name, file_hash)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["collection"] is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry["collection"]
+            self.misses += 1
+        collection = chromadb_agent.get_collection(collection_name)
+        self._put(key, {"collection": collection, "bm25": None, "size": COLLECTION_HANDLE_BYTES})
+        return collection
+
+    def get_bm25(self, collection_name: str, file_hash: str | None = None):
+        '''
+        (retriever, chunk ids) of the collection, loaded from its saved index on a miss,
+        None when no index was saved for it
+        '''
+        key = (collection_name, file_hash)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["bm25"] is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry["bm25"]
+            self.misses += 1
+        loaded = bm25_index_store.load(collection_name)
+        if loaded is None:
+            return None
+        self._put(key, {"collection": None, "bm25": loaded, "size": bm25_size_bytes(*loaded)})
+        return loaded
+
+    def _put(self, key: tuple[str, str | None], entry: dict):
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous["size"]
+            self.entries[key] = entry
+            self.total_bytes += entry["size"]
+            ##the entry just added is kept even when it alone is larger than the budget
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted["size"]
+                self.evictions += 1
+
+    def invalidate(self, collection_name: str):
+        '''drop every entry of the collection, e.g. when it is rebuilt or deleted'''
+        with self.lock:
+            self.versions[collection_name] = self.versions.get(collection_name, 0) + 1
+            for key in [key for key in self.entries if key[0] == collection_name]:
+                self.total_bytes -= self.entries.pop(key)["size"]
+
+    def stats(self)->dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+
+retrieval_cache = RetrievalCache()
@@ -0,0 +1,269 @@
+import os
+import asyncio
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from chromadb.api.models.Collection import Collection
+from dotenv import load_dotenv
+from model.bm25_index import Bm25IndexBuilder, bm25_index_store, bm25_search
+from model.retrieval_cache import retrieval_cache
+
+load_dotenv()
+
+RETRIEVAL_WORKERS = int(os.getenv("retrieval_workers", 2))
+RETRIEVAL_THREADS = int(os.getenv("retrieval_threads", 4)) ##threads running the chromadb reads of the server process
+RETRIEVAL_MAX_PENDING = int(os.getenv("retrieval_max_pending", 64)) ##requests queued or running in the workers and retrieval threads at once
+RETRIEVAL_QUEUE_TIMEOUT = float(os.getenv("retrieval_queue_timeout", 10)) ##seconds a request waits for a free slot before it is rejected
+BM25_MAX_RESULTS = 20
+
+
+class RetrievalBusyError(Exception):
+    '''raised when the retrieval slots stay taken for RETRIEVAL_QUEUE_TIMEOUT'''
+
+
+def vector_search_sort(collection: Collection, search_words: list[str])->list[tuple]:
+    '''
+    searching chromadb chunks via search keywords in ONE collections
+    return sorted list of tuple (chunk position, distance, document)
+    '''
+    DISTANCE_THRESHOLD = 1.7
+    MAX_RESULTS = 20
+    ##perform search query in the vector DB
+    results = collection.query(
+        query_texts=search_words,
+        n_results=MAX_RESULTS,
+        include=["documents", "metadatas", "distances"]
+    )
+    ##merge and scored each chunk
+    filtered_chunks = []
+    if results["ids"]:
+        for id in range(len(results["ids"])): ## for example there are 4 search words for the prompt
+            chunk_positions = [each["chunk_id"] for each in results["metadatas"][id]]
+            merged_chunks = list(zip(chunk_positions, results["distances"][id], results["documents"][id]))
+            filtered_chunks += [each for each in merged_chunks if each[1] < DISTANCE_THRESHOLD]
+    filtered_chunks.sort(key=lambda x:x[1])
+    return filtered_chunks
+
+def bm25_matched_chunks(collection: Collection, bm25_results: list[tuple[str, float]])->list[dict]:
+    '''
+    only the chunks matched by bm25 are read back from the collection
+    return list of sorted and merged dict {"id": 1, "score": 1.1, "document": "xxx"}
+    '''
+    matched_chunks = collection.get(ids=list({chunk_id for chunk_id, _ in bm25_results}), include=["documents", "metadatas"])
+    chunks = {
+        chunk_id: (metadata["chunk_id"], document)
+        for chunk_id, metadata, document in zip(matched_chunks["ids"], matched_chunks["metadatas"], matched_chunks["documents"])
+    }
+    filterd_bm25_results = [
+        {"id": chunks[chunk_id][0], "score": score, "document": chunks[chunk_id][1]}
+        for chunk_id, score in bm25_results if chunk_id in chunks
+    ]
+    filterd_bm25_results.sort(key=lambda x: x["score"], reverse=True)
+    return filterd_bm25_results
+
+def build_bm25_index(collection: Collection)->bool:
+    '''
+    build and save the bm25 index of a collection indexed before the index was saved at ingest time,
+    return False when the collection has no chunk to index
+    '''
+    all_chunks = collection.get(include=["documents"])
+    if not all_chunks["ids"]:
+        return False
+    bm25_builder = Bm25IndexBuilder()
+    bm25_builder.add(chunk_ids=all_chunks["ids"], chunks=all_chunks["documents"])
+    bm25_index_store.save(collection.name, bm25_builder)
+    return True
+
+def fetch_chunks_by_position(collection: Collection, chunk_ids: list[int])->dict[int, str]:
+    '''chunk texts of the given chunk positions which exist in the collection'''
+    result = collection.get(where={"chunk_id": {"$in": chunk_ids}}, include=["documents", "metadatas"])
+    return {metadata["chunk_id"]: document for metadata, document in zip(result["metadatas"], result["documents"])}
+
+
+##state of a worker process, only the bm25 retrievers loaded from the saved indexes stay warm between requests,
+##a worker opens no chromadb client and loads no embedding model
+_worker_versions: dict[str, int] = {}
+
+def _worker_bm25(collection_name: str, file_hash: str | None, version: int, queries: list[str], k: int)->tuple:
+    '''
+    runs in a worker process, return ([(chroma id, score)] or None when the collection has no saved index,
+    worker pid, worker retrieval cache stats)
+    '''
+    ##the collection was rebuilt or removed since this worker cached it
+    if _worker_versions.get(collection_name, 0) != version:
+        retrieval_cache.invalidate(collection_name)
+        _worker_versions[collection_name] = version
+    loaded = retrieval_cache.get_bm25(collection_name, file_hash=file_hash)
+    result = None if loaded is None else bm25_search(*loaded, queries=queries, k=k)
+    return result, os.getpid(), retrieval_cache.stats()
+
+
+class RetrievalService:
+    '''
+    bm25 scoring runs in a dedicated pool of worker processes which only load the saved bm25 indexes,
+    so scoring neither holds the GIL of the server nor competes with the default thread pool,
+    the vector query and the chunk reads stay in the server process on its one chromadb client
+    (a persistent client must not be shared by several processes) and run on a small thread pool of their own,
+    at most max_pending requests are in flight and the next caller waits (then fails) when it is full
+    '''
+    def __init__(
+            self,
+            workers: int = RETRIEVAL_WORKERS,
+            threads: int = RETRIEVAL_THREADS,
+            max_pending: int = RETRIEVAL_MAX_PENDING,
+            queue_timeout: float = RETRIEVAL_QUEUE_TIMEOUT
+        ):
+        self.workers = workers
+        self.threads = threads
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self.pool: ProcessPoolExecutor | None = None
+        self.thread_pool: ThreadPoolExecutor | None = None
+        self.slots: asyncio.Semaphore | None = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.worker_cache_stats: dict[int, dict] = {} ##pid -> retrieval cache stats reported with the last response
+
+    def start(self):
+        if self.pool is None:
+            ##spawn so the workers do not inherit the server's threads and event loop
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            self.thread_pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="retrieval")
+            self.slots = asyncio.Semaphore(self.max_pending)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.thread_pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+            self.thread_pool = None
+            self.slots = None
+
+    async def _run(self, in_worker: bool, func, *args, limit: asyncio.Semaphore | None = None):
+        '''
+        run func(*args) in a worker process or a retrieval thread once a slot (and one of limit, e.g. a tool call's cap) is free,
+        the slots are held until the worker or thread is done, a caller which times out or is cancelled does not free them early
+        '''
+        self.start()
+        acquired = []
+        try:
+            if limit is not None:
+                await limit.acquire()
+                acquired.append(limit)
+            try:
+                await asyncio.wait_for(self.slots.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise RetrievalBusyError(f"retrieval workers are busy, {self.pending} requests pending")
+            acquired.append(self.slots)
+            future = (self.pool if in_worker else self.thread_pool).submit(func, *args)
+        except BaseException:
+            for semaphore in acquired:
+                semaphore.release()
+            raise
+        self.pending += 1
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda done: loop.is_closed() or loop.call_soon_threadsafe(self._finished, done, acquired))
+        return await asyncio.wrap_future(future)
+
+    def _finished(self, future: Future, acquired: list[asyncio.Semaphore]):
+        self.pending -= 1
+        if not future.cancelled():
+            if future.exception() is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+        for semaphore in acquired:
+            semaphore.release()
+
+    async def _collection(self, chromadb_agent, collection_name: str, file_hash: str | None, limit: asyncio.Semaphore | None)->Collection:
+        return await self._run(False, retrieval_cache.get_collection, chromadb_agent, collection_name, file_hash, limit=limit)
+
+    async def _bm25_scores(
+            self,
+            collection_name: str,
+            file_hash: str | None,
+            search_keywords: list[str],
+            limit: asyncio.Semaphore | None
+        )->list[tuple[str, float]] | None:
+        result, pid, cache_stats = await self._run(
+            True,
+            _worker_bm25,
+            collection_name,
+            file_hash,
+            retrieval_cache.version(collection_name),
+            search_keywords,
+            BM25_MAX_RESULTS,
+            limit=limit
+        )
+        self.worker_cache_stats[pid] = cache_stats
+        return result
+
+    async def vector_search(
+            self,
+            chromadb_agent,
+            collection_name: str,
+            file_hash: str | None,
+            search_words: list[str],
+            limit: asyncio.Semaphore | None = None
+        )->list[tuple]:
+        collection = await self._collection(chromadb_agent, collection_name, file_hash, limit)
+        return await self._run(False, vector_search_sort, collection, search_words, limit=limit)
+
+    async def bm25_search(
+            self,
+            chromadb_agent,
+            collection_name: str,
+            file_hash: str | None,
+            search_keywords: list[str],
+            limit: asyncio.Semaphore | None = None
+        )->list[dict]:
+        bm25_results = await self._bm25_scores(collection_name, file_hash, search_keywords, limit)
+        collection = await self._collection(chromadb_agent, collection_name, file_hash, limit)
+        if bm25_results is None:
+            ##collections indexed before the index was saved at ingest time get it built here once
+            if not await self._run(False, build_bm25_index, collection, limit=limit):
+                return []
+            bm25_results = await self._bm25_scores(collection_name, file_hash, search_keywords, limit) or []
+        if not bm25_results:
+            return []
+        return await self._run(False, bm25_matched_chunks, collection, bm25_results, limit=limit)
+
+    async def fetch_chunks(
+            self,
+            chromadb_agent,
+            collection_name: str,
+            file_hash: str | None,
+            chunk_ids: list[int],
+            limit: asyncio.Semaphore | None = None
+        )->dict[int, str]:
+        if not chunk_ids:
+            return {}
+        collection = await self._collection(chromadb_agent, collection_name, file_hash, limit)
+        return await self._run(False, fetch_chunks_by_position, collection, chunk_ids, limit=limit)
+
+    def stats(self)->dict:
+        worker_stats = list(self.worker_cache_stats.values())
+        hits = sum(each["hits"] for each in worker_stats)
+        misses = sum(each["misses"] for each in worker_stats)
+        return {
+            "workers": self.workers,
+            "threads": self.threads,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "worker_retrieval_cache": {
+                "entries": sum(each["entries"] for each in worker_stats),
+                "bytes": sum(each["bytes"] for each in worker_stats),
+                "hits": hits,
+                "misses": misses,
+                "evictions": sum(each["evictions"] for each in worker_stats),
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0
+            }
+        }
+
+
+retrieval_service = RetrievalService()
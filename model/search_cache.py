@@ -0,0 +1,141 @@
+import os
+import json
+import asyncio
+import hashlib
+from time import time, perf_counter
+from typing import Awaitable, Callable
+from sqlalchemy import select, delete, func
+from dotenv import load_dotenv
+from model.sqlite import AsyncSessionLocal, SearchResult
+
+load_dotenv()
+
+SEARCH_CACHE_TTL_SECONDS = float(os.getenv("search_cache_ttl_seconds", 6 * 3600))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("search_cache_max_entries", 20_000))
+
+
+def normalize_query(query: str)->str:
+    '''the same question in another case or spacing shares one cache entry'''
+    return " ".join(query.lower().split())
+
+
+class SearchResultCache:
+    '''
+    tavily responses kept in the app sqlite db and shared across sessions,
+    keyed by sha256(normalised query, search options), entries expire after ttl_seconds
+    and the least recently used go once the table holds more than max_entries rows,
+    concurrent lookups of the same key wait for one upstream call (single flight)
+    '''
+    def __init__(self, ttl_seconds: float = SEARCH_CACHE_TTL_SECONDS, max_entries: int = SEARCH_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.inflight: dict[str, asyncio.Task] = {}
+        self.entry_count: int | None = None ##counted on the first insert
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.time_saved = 0.0 ##upstream seconds the hits did not spend
+
+    @staticmethod
+    def key(query: str, options: dict)->str:
+        payload = json.dumps([normalize_query(query), options], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8", errors="surrogatepass")).hexdigest()
+
+    async def get(self, cache_key: str)->tuple[dict, float] | None:
+        '''(cached result, seconds its upstream call took), None for a miss or an expired entry'''
+        now = time()
+        async with AsyncSessionLocal() as db:
+            entry = await db.get(SearchResult, cache_key)
+            if entry is None:
+                return None
+            if entry.expires_at <= now:
+                await db.delete(entry)
+                await db.commit()
+                if self.entry_count is not None:
+                    self.entry_count -= 1
+                return None
+            entry.last_used = now
+            await db.commit()
+            return json.loads(entry.result), entry.fetch_seconds
+
+    async def put(self, cache_key: str, query: str, result: dict, fetch_seconds: float):
+        now = time()
+        async with AsyncSessionLocal() as db:
+            if self.entry_count is None:
+                self.entry_count = (await db.execute(select(func.count()).select_from(SearchResult))).scalar_one()
+            is_new = await db.get(SearchResult, cache_key) is None
+            await db.merge(SearchResult(
+                cache_key=cache_key,
+                query=query,
+                result=json.dumps(result, ensure_ascii=False, default=str),
+                fetch_seconds=fetch_seconds,
+                expires_at=now + self.ttl_seconds,
+                last_used=now
+            ))
+            self.entry_count += int(is_new)
+            overflow = self.entry_count - self.max_entries
+            if overflow > 0:
+                ##expired rows go first, then a little more than needed so eviction does not run on every insert
+                expired = await db.execute(delete(SearchResult).where(SearchResult.expires_at <= now))
+                evicted = expired.rowcount
+                overflow -= evicted
+                if overflow > 0:
+                    oldest = select(SearchResult.cache_key).order_by(SearchResult.last_used.asc()).limit(overflow + max(1, self.max_entries // 100))
+                    result_rows = await db.execute(delete(SearchResult).where(SearchResult.cache_key.in_(oldest)))
+                    evicted += result_rows.rowcount
+                self.entry_count -= evicted
+                self.evictions += evicted
+            await db.commit()
+
+    async def _fetch_and_store(self, cache_key: str, query: str, fetch: Callable[[], Awaitable[dict]])->dict:
+        start = perf_counter()
+        result = await fetch()
+        await self.put(cache_key, query, result, fetch_seconds=perf_counter() - start)
+        return result
+
+    async def get_or_fetch(self, query: str, options: dict, fetch: Callable[[], Awaitable[dict]])->dict:
+        '''
+        the cached result of the query and options, otherwise await fetch() once for every concurrent caller and cache it,
+        failed fetches are not cached
+        '''
+        cache_key = SearchResultCache.key(query, options)
+        task = self.inflight.get(cache_key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+        cached = await self.get(cache_key)
+        if cached is not None:
+            result, fetch_seconds = cached
+            self.hits += 1
+            self.time_saved += fetch_seconds
+            return result
+        ##another caller may have started the fetch while the db was read
+        task = self.inflight.get(cache_key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+        self.misses += 1
+        task = asyncio.create_task(self._fetch_and_store(cache_key, normalize_query(query), fetch))
+        self.inflight[cache_key] = task
+        task.add_done_callback(lambda _: self.inflight.pop(cache_key, None))
+        ##shielded so a cancelled caller does not cancel the fetch the others are waiting for
+        return await asyncio.shield(task)
+
+    def stats(self)->dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": self.entry_count,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "inflight": len(self.inflight),
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "time_saved_seconds": round(self.time_saved, 3)
+        }
+
+
+search_cache = SearchResultCache()
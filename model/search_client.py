@@ -0,0 +1,163 @@
+import os
+import asyncio
+import random
+import httpx
+from time import monotonic
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TAVILY_SEARCH_URL = "https://api.tavily.com/search"
+SEARCH_RATE_PER_SEC = float(os.getenv("search_rate_per_sec", 5)) ##upstream searches started per second across the process
+SEARCH_BURST = int(os.getenv("search_burst", 10)) ##searches allowed at once after an idle period
+SEARCH_MAX_CONCURRENCY = int(os.getenv("search_max_concurrency", 8)) ##upstream searches in flight, also the connection pool size
+SEARCH_SESSION_CONCURRENCY = int(os.getenv("search_session_concurrency", 2)) ##in flight searches of one session, so one session cannot take every slot
+SEARCH_MAX_RETRIES = int(os.getenv("search_max_retries", 3))
+SEARCH_BACKOFF_SECONDS = float(os.getenv("search_backoff_seconds", 0.5)) ##base of the exponential backoff
+SEARCH_TIMEOUT = float(os.getenv("search_timeout", 30))
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    '''
+    refills rate tokens per second up to burst, acquire() waits until a token is available
+    '''
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self)->float:
+        '''take one token, return the seconds spent waiting for it'''
+        waited = 0.0
+        ##the lock keeps waiters in arrival order
+        async with self.lock:
+            while True:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+
+class SearchClientManager:
+    '''
+    every tavily search of the process goes through one pooled http client,
+    limited by a global token bucket and a global concurrency cap,
+    each session holds at most session_concurrency of the slots so a session with many topics cannot starve the others,
+    429 and 5xx responses and transport errors are retried with full jitter exponential backoff
+    '''
+    def __init__(
+            self,
+            rate_per_sec: float = SEARCH_RATE_PER_SEC,
+            burst: int = SEARCH_BURST,
+            max_concurrency: int = SEARCH_MAX_CONCURRENCY,
+            session_concurrency: int = SEARCH_SESSION_CONCURRENCY,
+            max_retries: int = SEARCH_MAX_RETRIES,
+            backoff_seconds: float = SEARCH_BACKOFF_SECONDS,
+            timeout: float = SEARCH_TIMEOUT
+        ):
+        self.max_concurrency = max_concurrency
+        self.session_concurrency = session_concurrency
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate=rate_per_sec, burst=burst)
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.sessions: dict[str, list] = {} ##session id -> [semaphore, callers using it]
+        self.client: httpx.AsyncClient | None = None
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.throttled_seconds = 0.0
+
+    def get_client(self)->httpx.AsyncClient:
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+            )
+        return self.client
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _session_slot(self, session_id: str)->list:
+        slot = self.sessions.get(session_id)
+        if slot is None:
+            slot = self.sessions[session_id] = [asyncio.Semaphore(self.session_concurrency), 0]
+        slot[1] += 1
+        return slot
+
+    def _release_session_slot(self, session_id: str, slot: list):
+        slot[1] -= 1
+        if slot[1] == 0:
+            self.sessions.pop(session_id, None)
+
+    def backoff(self, attempt: int, retry_after: str | None = None)->float:
+        '''seconds before the next attempt, the server's Retry-After wins when it is given in seconds'''
+        if retry_after is not None:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                pass
+        return random.uniform(0, self.backoff_seconds * 2 ** attempt)
+
+    async def _post(self, payload: dict)->dict:
+        client = self.get_client()
+        for attempt in range(self.max_retries + 1):
+            self.throttled_seconds += await self.bucket.acquire()
+            self.requests += 1
+            try:
+                response = await client.post(
+                    TAVILY_SEARCH_URL,
+                    json=payload,
+                    headers={"Authorization": f"Bearer {os.getenv('tavily_api_key')}"}
+                )
+            except httpx.TransportError:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(self.backoff(attempt))
+                continue
+            if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                self.retries += 1
+                await asyncio.sleep(self.backoff(attempt, response.headers.get("retry-after")))
+                continue
+            response.raise_for_status()
+            return response.json()
+
+    async def search(self, query: str, session_id: str = "", **options)->dict:
+        '''tavily search response of the query, options are passed through (max_results, search_depth, ...)'''
+        slot = self._session_slot(session_id)
+        try:
+            async with slot[0], self.slots:
+                return await self._post({"query": query, **options})
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self._release_session_slot(session_id, slot)
+
+    def stats(self)->dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "session_concurrency": self.session_concurrency,
+            "rate_per_sec": self.bucket.rate,
+            "active_sessions": len(self.sessions),
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "throttled_seconds": round(self.throttled_seconds, 3)
+        }
+
+
+search_client = SearchClientManager()
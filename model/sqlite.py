@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime
+from sqlalchemy import Column, Integer, String, Text, DateTime, Float, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
@@ -16,6 +16,86 @@ class SummaryIndex(Base):
 
     def __repr__(self):
         return f"<SummaryIndex(session_id='{self.session_id}')>"
+
+
+class ContentBlob(Base):
+    '''
+    content-addressed artifacts of an uploaded file, shared by every session uploading the same bytes
+    '''
+    __tablename__ = "content_blob"
+    file_hash = Column(String, primary_key=True) ##sha256 of the raw uploaded bytes
+    content_path = Column(String, nullable=False) ##extracted text on disk
+    collection_name = Column(String, nullable=True) ##chromadb collection holding the chunk embeddings, None if not indexed
+    num_tokens = Column(Integer, nullable=False, default=0)
+    process_method = Column(String, nullable=False)
+    summary = Column(Text, nullable=True)
+    ref_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<ContentBlob(file_hash='{self.file_hash}', ref_count={self.ref_count})>"
+
+
+class FileReference(Base):
+    __tablename__ = "file_reference"
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    session_id = Column(String, nullable=False, index=True)
+    file_name = Column(String, nullable=False)
+    file_hash = Column(String, nullable=False, index=True)
+    updated_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<FileReference(session_id='{self.session_id}', file_name='{self.file_name}')>"
+
+
+class SectionSummary(Base):
+    '''
+    partial summary of a group of chunks, keyed by the hash of the chunk hashes so unchanged sections of a re-upload are not summarised again,
+    rows expire and are capped in utils/file_summarizer.py
+    '''
+    __tablename__ = "section_summary"
+    section_hash = Column(String, primary_key=True)
+    summary = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<SectionSummary(section_hash='{self.section_hash}')>"
+
+
+class RegisteredCollection(Base):
+    '''
+    registry of the chromadb collection each indexed file of a session is searched in,
+    so lookups, listing and per session deletion never scan every collection of the node
+    '''
+    __tablename__ = "collection_registry"
+    __table_args__ = (UniqueConstraint("session_id", "file_name", name="uq_collection_registry_session_file"),)
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    session_id = Column(String, nullable=False, index=True)
+    file_name = Column(String, nullable=False)
+    collection_name = Column(String, nullable=False, index=True)
+    file_hash = Column(String, nullable=True)
+    chunk_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<RegisteredCollection(session_id='{self.session_id}', file_name='{self.file_name}', collection_name='{self.collection_name}')>"
+
+
+class SearchResult(Base):
+    '''
+    tavily response of a normalised query and its search options, shared by every session until expires_at,
+    fetch_seconds is how long the upstream call took so cache hits can report the time they saved
+    '''
+    __tablename__ = "search_result_cache"
+    cache_key = Column(String, primary_key=True)
+    query = Column(Text, nullable=False)
+    result = Column(Text, nullable=False)
+    fetch_seconds = Column(Float, nullable=False, default=0.0)
+    expires_at = Column(Float, nullable=False)
+    last_used = Column(Float, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<SearchResult(cache_key='{self.cache_key}', query='{self.query}')>"
     
 DATABASE_URL = "sqlite+aiosqlite:///sqlite/app/app_session.db"
 engine = create_async_engine(DATABASE_URL, echo=False)
@@ -0,0 +1,25 @@
+from fastapi import APIRouter, status
+from fastapi.responses import JSONResponse
+from model.embedding_service import embedding_service
+from model.embedding_cache import embedding_cache
+from model.retrieval_cache import retrieval_cache
+from model.query_cache import query_cache
+from model.retrieval_service import retrieval_service
+from model.search_cache import search_cache
+from model.search_client import search_client
+
+
+metrics_router = APIRouter()
+
+@metrics_router.get("/api/metrics")
+def get_metrics()->JSONResponse:
+    '''runtime counters of the ingestion and retrieval caches and workers'''
+    return JSONResponse(status_code=status.HTTP_200_OK, content={
+        "embedding_service": embedding_service.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "retrieval_cache": retrieval_cache.stats(),
+        "query_cache": query_cache.stats(),
+        "retrieval_service": retrieval_service.stats(),
+        "search_cache": search_cache.stats(),
+        "search_client": search_client.stats()
+    })
@@ -4,7 +4,7 @@ from typing import List
 from fastapi.responses import JSONResponse, FileResponse
 from fastapi import status, APIRouter, UploadFile, HTTPException, Depends
 from model.memory import checkpointer_manager
-from utils.helper_funcs import file_upload_handler
+from utils.helper_funcs import file_upload_handler, staging_dir, MAX_CONCURRENT_UPLOADS
 import asyncio
 from model.file_parser import Chromadb_agent
 from model.dependency.dependencies import get_chromadb_agent_singleton, get_db
@@ -13,7 +13,9 @@ from sqlalchemy import delete
 from model.sqlite import SummaryIndex
 import mimetypes
 from urllib.parse import quote
-from model.session_manager import manager
+from model.ingestion_jobs import ingestion_manager
+from model.content_store import content_store
+from model.collection_registry import collection_registry
 
 
 session_router =  APIRouter()
@@ -21,31 +23,43 @@ session_router =  APIRouter()
 @session_router.post("/api/{session_id}/upload")
 async def file_upload(
         session_id: str, 
-        files: List[UploadFile], 
-        chromadb_agent: Chromadb_agent = Depends(get_chromadb_agent_singleton)
+        files: List[UploadFile]
     )->JSONResponse:
     try:
         os.makedirs(f"uploads/{session_id}", exist_ok=True)
-        corutines = [file_upload_handler(
-            file=file, 
-            session_id=session_id, 
-            chromadb_client=chromadb_agent
-        ) for file in files]
-
-        results = await asyncio.gather(*corutines)
-        session = manager.get_session(thread_id=session_id)
-        session["file_upload"] = results
-        # failed_uploads = list(filter(lambda x: x.== False, results))
-        
+        ##cap the number of files streamed at once within this request
+        upload_semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+
+        async def bounded_file_upload_handler(file: UploadFile):
+            async with upload_semaphore:
+                return await file_upload_handler(file=file, session_id=session_id)
 
-        # if failed_uploads:
-        #     failed_names = (", ").join([upload["name"] for upload in failed_uploads])
-        #     return JSONResponse(status_code=status.HTTP_201_CREATED, content=f"{failed_names} failed in uploads")
-        # else:
-        return JSONResponse(status_code=status.HTTP_201_CREATED, content="files has been uploaded.")
+        results = await asyncio.gather(*[bounded_file_upload_handler(file) for file in files])
+        ##extraction, indexing and summary run in the ingestion workers, each on the staged copy of its own upload
+        jobs = [
+            ingestion_manager.submit(
+                session_id=session_id,
+                uploaded_file=each,
+                file_path=str(staged_path)
+            ) for each, staged_path in results if not each.error
+        ]
+        rejected_uploads = [{"file_name": each.file_name, "error": each.error} for each, _ in results if each.error]
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={
+            "message": "files has been uploaded.",
+            "jobs": [{"job_id": job.job_id, "file_name": job.file_name, "stage": job.stage} for job in jobs],
+            "rejected": rejected_uploads
+        })
         
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Server Side Error: {e}")
+
+
+@session_router.get("/api/{session_id}/jobs/{job_id}")
+async def get_ingestion_job(session_id: str, job_id: str)->JSONResponse:
+    job = ingestion_manager.get_job(job_id=job_id)
+    if job is None or job.session_id != session_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"{job_id} does not exist")
+    return JSONResponse(status_code=status.HTTP_200_OK, content=job.model_dump(exclude={"file_path"}))
     
 
 @session_router.delete("/api/{session_id}")
@@ -64,8 +78,20 @@ async def delete_files_index_via_session(
         #         "error": f"{session_id} is not valid"
         #     })
 
-        chromadb_agent = Chromadb_agent() #remove the collection in chromadb
-        result = chromadb_agent.remove_collection_by_session_id(session_id=session_id)
+        ##stop the session's ingestion jobs first, a running job undoes what it links after this point
+        ingestion_manager.remove_session(session_id=session_id)
+        ##drop the session's references, shared content is only freed when no other session uses it
+        released_collections = await content_store.release_session(session_id=session_id)
+        registered_collections = await collection_registry.remove_session(session_id=session_id)
+        ##remove the collection in chromadb, uploads indexed before the registry existed are found by their file names
+        file_names = os.listdir(f"coding_space/{session_id}") if os.path.isdir(f"coding_space/{session_id}") else []
+        result = await asyncio.to_thread(
+            chromadb_agent.remove_collection_by_session_id,
+            session_id=session_id,
+            registered_collections=registered_collections,
+            released_collections=released_collections,
+            file_names=file_names
+        )
 
         ##remove the directory for file uploads
         if os.path.exists(f"coding_space/{session_id}"):
@@ -76,6 +102,10 @@ async def delete_files_index_via_session(
                 elif os.path.isdir(file_path):
                     shutil.rmtree(file_path)
         
+        ##remove the staged uploads of jobs which never ran
+        if os.path.isdir(staging_dir(session_id)):
+            shutil.rmtree(staging_dir(session_id))
+
         ##remove the directory for artifactory download
         if os.path.isdir(f"artifactories/{session_id}"):
             shutil.rmtree(f"artifactories/{session_id}")
@@ -0,0 +1,24 @@
+import os
+os.environ.setdefault("api_key", "test")
+from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+from model.file_parser import Chromadb_agent
+
+
+def test_reopen_collection_created_with_default_embedding_function(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    chromadb_agent = Chromadb_agent()
+    ##collections indexed before the cached embedding function persisted chromadb's "default" function
+    legacy = chromadb_agent.chromadb_client.create_collection("session_report.pdf", embedding_function=DefaultEmbeddingFunction())
+    legacy.add(ids=["chunk_0"], documents=["legacy chunk"], embeddings=[[0.1] * 384], metadatas=[{"chunk_id": 0}])
+
+    collection = chromadb_agent.get_collection("session_report.pdf")
+    assert collection.get(ids=["chunk_0"])["documents"] == ["legacy chunk"]
+    assert chromadb_agent.get_or_create_collection("session_report.pdf").count() == 1
+    assert chromadb_agent.get_collection_or_none("session_report.pdf") is not None
+
+
+def test_new_collection_uses_cached_embedding_function(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    chromadb_agent = Chromadb_agent()
+    chromadb_agent.get_or_create_collection("content_new")
+    assert chromadb_agent.get_collection("content_new").configuration_json["embedding_function"]["name"] == "cached_all_minilm_l6_v2"
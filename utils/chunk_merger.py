@@ -0,0 +1,106 @@
+from typing import Callable, Iterable
+from utils.streaming_splitter import CHUNK_OVERLAP
+
+MIN_STITCH_OVERLAP = CHUNK_OVERLAP // 2 ##shorter matches are more likely chance repeats than the splitter's overlap
+
+
+def overlap_length(previous: str, following: str, max_overlap: int = CHUNK_OVERLAP, min_overlap: int = MIN_STITCH_OVERLAP)->int:
+    '''
+    length of the longest suffix of previous which is also a prefix of following, up to max_overlap chars,
+    0 when it is shorter than min_overlap
+    '''
+    for length in range(min(max_overlap, len(previous), len(following)), min_overlap - 1, -1):
+        if length > 0 and previous.endswith(following[:length]):
+            return length
+    return 0
+
+def stitch(previous: str, following: str, max_overlap: int = CHUNK_OVERLAP)->str:
+    '''
+    join two consecutive chunks, dropping the text the splitter repeated at the start of the second one,
+    without an overlap of at least MIN_STITCH_OVERLAP chars nothing is dropped and the chunks are joined by a newline,
+    so the passage may repeat a short overlap or gain a newline the document did not have instead of losing a chance match
+    '''
+    length = overlap_length(previous, following, max_overlap=max_overlap)
+    if length:
+        return previous + following[length:]
+    return previous + "\n" + following
+
+def merge_adjacent_chunks(chunks: Iterable[tuple[int, str]], max_overlap: int = CHUNK_OVERLAP)->list[tuple[int, int, str]]:
+    '''
+    stitch runs of consecutive chunk ids into spans without the repeated overlap (see stitch)
+    return (first chunk id, last chunk id, text) in chunk order
+    '''
+    spans = []
+    for chunk_id, chunk in sorted(chunks, key=lambda x: x[0]):
+        if spans and chunk_id == spans[-1][1]:
+            continue ##the same chunk given twice
+        if spans and chunk_id == spans[-1][1] + 1:
+            first_id, _, text = spans[-1]
+            spans[-1] = (first_id, chunk_id, stitch(text, chunk, max_overlap=max_overlap))
+        else:
+            spans.append((chunk_id, chunk_id, chunk))
+    return spans
+
+def neighbour_ids(
+        hit_ids: list[int],
+        neighbours: int,
+        token_budget: int,
+        chunk_tokens: int,
+        total_chunks: int | None = None
+    )->list[int]:
+    '''
+    ids within +-neighbours of the hits (best hit first, nearest neighbour first) which fit in token_budget,
+    each neighbour is costed at chunk_tokens
+    '''
+    selected = set(hit_ids)
+    expansion = []
+    remaining_budget = token_budget
+    for distance in range(1, neighbours + 1):
+        for hit_id in hit_ids:
+            for candidate in (hit_id - distance, hit_id + distance):
+                if candidate < 0 or (total_chunks is not None and candidate >= total_chunks) or candidate in selected:
+                    continue
+                if remaining_budget < chunk_tokens:
+                    return expansion
+                selected.add(candidate)
+                expansion.append(candidate)
+                remaining_budget -= chunk_tokens
+    return expansion
+
+def neighbour_candidates(
+        hits: dict[int, str],
+        neighbours: int,
+        token_budget: int,
+        count_tokens: Callable[[str], int],
+        total_chunks: int | None = None
+    )->list[int]:
+    '''
+    chunk ids around the hits (best hit first) worth fetching for expand_with_neighbours,
+    costed at the average token count of the hits
+    '''
+    if neighbours <= 0 or not hits:
+        return []
+    average_tokens = max(1, sum(count_tokens(chunk) for chunk in hits.values()) // len(hits))
+    return neighbour_ids(list(hits), neighbours, token_budget, average_tokens, total_chunks=total_chunks)
+
+def expand_with_neighbours(
+        hits: dict[int, str],
+        candidates: list[int],
+        fetched: dict[int, str],
+        token_budget: int,
+        count_tokens: Callable[[str], int]
+    )->dict[int, str]:
+    '''
+    add the fetched neighbour chunks in candidate order while the tokens they add stay within token_budget
+    '''
+    expanded = dict(hits)
+    used_tokens = 0
+    for chunk_id in candidates:
+        if chunk_id not in fetched:
+            continue
+        tokens = count_tokens(fetched[chunk_id])
+        if used_tokens + tokens > token_budget:
+            break
+        expanded[chunk_id] = fetched[chunk_id]
+        used_tokens += tokens
+    return expanded
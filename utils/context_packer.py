@@ -0,0 +1,40 @@
+from collections import defaultdict
+from typing import Callable
+from utils.token_counter import cached_token_counts
+
+PASSAGE_OVERHEAD_TOKENS = 8 ##file label and separators around each packed passage
+
+
+def pack_passages(
+        passages: list[dict],
+        token_budget: int,
+        count_tokens: Callable[[str], int] = cached_token_counts
+    )->tuple[list[dict], int]:
+    '''
+    fill the token budget greedily with the passages ({"file", "content", "score", ...}) in score order,
+    a passage too large for what is left is skipped so smaller ones after it can still fit
+    return (packed passages, packed tokens)
+    '''
+    packed = []
+    packed_tokens = 0
+    for passage in sorted(passages, key=lambda x: x.get("score", 0), reverse=True):
+        tokens = count_tokens(passage["content"]) + PASSAGE_OVERHEAD_TOKENS
+        if packed_tokens + tokens > token_budget:
+            continue
+        packed.append(passage)
+        packed_tokens += tokens
+    return packed, packed_tokens
+
+def format_passages(passages: list[dict], errors: list[dict] | None = None)->str:
+    '''
+    packed passages grouped by file, in document order within each file, followed by the search errors
+    '''
+    file_passages = defaultdict(list)
+    for passage in passages:
+        file_passages[passage["file"]].append(passage)
+    sections = []
+    for file_name, each_file_passages in file_passages.items():
+        each_file_passages.sort(key=lambda x: x.get("chunk_ids", [0])[0])
+        sections.append(f"file: {file_name}\n" + "\n...\n".join(each["content"] for each in each_file_passages))
+    sections += [str(each) for each in errors or []]
+    return "\n\n".join(sections)
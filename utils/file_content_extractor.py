@@ -1,60 +1,139 @@
-from fastapi import UploadFile
-from pathlib import Path
+import os
+import math
 import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, AsyncIterator
+from collections import deque
 import pdfplumber
 from docx import Document
 from pptx import Presentation
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EXTRACTION_WORKERS = int(os.getenv("extraction_workers", os.cpu_count() or 1))
+PAGES_PER_TASK = int(os.getenv("extraction_pages_per_task", 50)) ##upper bound of pages/slides handled by one worker task
+
+_extraction_pool: ProcessPoolExecutor | None = None
+
+
+def get_extraction_pool()->ProcessPoolExecutor:
+    '''
+    dedicated process pool for extraction so parsing runs outside the GIL and off the default to_thread pool,
+    spawn is used so workers do not inherit the server's threads
+    '''
+    global _extraction_pool
+    if _extraction_pool is None:
+        _extraction_pool = ProcessPoolExecutor(
+            max_workers=EXTRACTION_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _extraction_pool
+
+def shutdown_extraction_pool():
+    global _extraction_pool
+    if _extraction_pool is not None:
+        _extraction_pool.shutdown(wait=False, cancel_futures=True)
+        _extraction_pool = None
+
+def page_ranges(total_pages: int, workers: int, pages_per_task: int | None = PAGES_PER_TASK)->list[tuple[int, int]]:
+    '''
+    split [0, total_pages) into ordered (start, end) ranges, at least one range per worker when possible,
+    pages_per_task None means exactly one range per worker
+    '''
+    if total_pages <= 0:
+        return []
+    range_size = math.ceil(total_pages / max(1, workers))
+    if pages_per_task is not None:
+        range_size = min(pages_per_task, range_size)
+    range_size = max(1, range_size)
+    return [(start, min(start + range_size, total_pages)) for start in range(0, total_pages, range_size)]
 
 
-def pdf_extractor(file: Path)->list[str]:
-    text = ""
+def pdf_page_count(file: Path)->int:
     with pdfplumber.open(file) as pdf:
-        for idx, page in enumerate(pdf.pages):
+        return len(pdf.pages)
+
+def pdf_range_extractor(file: Path, start: int, end: int)->list[str]:
+    '''extract the pages [start, end) of the pdf, one string per non-empty page'''
+    page_texts = []
+    with pdfplumber.open(file, pages=list(range(start + 1, end + 1))) as pdf: ##pdfplumber page numbers are 1-based
+        for idx, page in zip(range(start, end), pdf.pages):
             try:
                 page_text = page.extract_text()
                 if page_text:
-                    text += f"Page {idx}: {page_text}\n"
+                    page_texts.append(f"Page {idx}: {page_text}")
             except Exception as page_error:
                 raise Exception(str(page_error))
-    return text
-        
-def word_extractor(file: Path)->str:
+            finally:
+                page.close() ##release the parsed page objects as we go
+    return page_texts
+
+
+def word_paragraph_count(file: Path)->int:
+    return len(Document(file).paragraphs)
+
+def word_range_extractor(file: Path, start: int, end: int)->list[str]:
     doc = Document(file)
-    text = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-    return text
+    return [paragraph.text for paragraph in doc.paragraphs[start:end]]
 
-def pptx_extractor(file: Path)->str:
-    prs = Presentation(file)
-    text_content = []
 
+def pptx_slide_count(file: Path)->int:
+    return len(Presentation(file).slides)
+
+def pptx_range_extractor(file: Path, start: int, end: int)->list[str]:
+    '''extract the slides [start, end), one string per slide'''
+    prs = Presentation(file)
+    slide_texts = []
     for slide_num, slide in enumerate(prs.slides, start=1):
-        text_content.append(f"--- Slide {slide_num} ---")
+        if slide_num <= start:
+            continue
+        if slide_num > end:
+            break
+        text_content = [f"--- Slide {slide_num} ---"]
         for shape in slide.shapes:
             if shape.has_text_frame:
                 for paragraph in shape.text_frame.paragraphs:
                     if paragraph.text.strip():
                         text_content.append(paragraph.text)
-    return "\n".join(text_content)    
+        slide_texts.append("\n".join(text_content))
+    return slide_texts
+
+
+EXTRACTORS: dict[str, tuple[Callable[[Path], int], Callable[[Path, int, int], list[str]], int | None]] = {
+    ##suffix: (page count, page range extractor, pages per task)
+    ".pdf": (pdf_page_count, pdf_range_extractor, PAGES_PER_TASK),
+    ".pptx": (pptx_slide_count, pptx_range_extractor, None),
+    ".ppt": (pptx_slide_count, pptx_range_extractor, None),
+    ".docx": (word_paragraph_count, word_range_extractor, None),
+    ".doc": (word_paragraph_count, word_range_extractor, None),
+}
 
-async def file_content_extract(file_path: Path = None)->tuple[bool, str]:
+async def iter_file_content(
+        file_path: Path,
+        pool: ProcessPoolExecutor | None = None,
+        workers: int = EXTRACTION_WORKERS
+    )->AsyncIterator[str]:
     '''
-    return bool result of content extraction result,
-    return content is str format
+    yield the page (slide, paragraph) texts of the document in order,
+    at most `workers` page ranges are extracted ahead of the consumer so only a bounded window of text is held
     '''
-    content = ""
-    try:
-        if file_path.exists():
-            if file_path.suffix == ".pdf":
-                content = await asyncio.to_thread(pdf_extractor, file_path)
-            elif file_path.suffix in [".pptx", ".ppt"]:
-                content = await asyncio.to_thread(pptx_extractor, file_path)
-            elif file_path.suffix in [".doc", ".docx"]:
-                content = await asyncio.to_thread(word_extractor, file_path)
-            else:
-                raise Exception(f"File type of {file_path.name} is not supported..")
-            return (True, content)
-        else:
-            return (False, "File does not exist")
-    except Exception as e:
-        return (False, str(e))
-        
\ No newline at end of file
+    if not file_path.exists():
+        raise Exception("File does not exist")
+    if file_path.suffix not in EXTRACTORS:
+        raise Exception(f"File type of {file_path.name} is not supported..")
+    count_func, range_func, pages_per_task = EXTRACTORS[file_path.suffix]
+    loop = asyncio.get_running_loop()
+    pool = pool or get_extraction_pool()
+    total_pages = await loop.run_in_executor(pool, count_func, file_path)
+    pending = deque()
+    for start, end in page_ranges(total_pages, workers, pages_per_task):
+        pending.append(loop.run_in_executor(pool, range_func, file_path, start, end))
+        if len(pending) >= workers:
+            for text in await pending.popleft():
+                yield text
+    while pending:
+        for text in await pending.popleft():
+            yield text
@@ -0,0 +1,159 @@
+import os
+import asyncio
+import hashlib
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator
+from openai import AsyncOpenAI
+from sqlalchemy import select, delete, func
+from dotenv import load_dotenv
+from model.sqlite import AsyncSessionLocal, SectionSummary
+from utils.streaming_splitter import iter_chunks
+from utils.token_counter import cached_token_counts
+
+load_dotenv()
+
+SUMMARY_CONCURRENCY = int(os.getenv("summary_concurrency", 4)) ##section summaries requested from the llm at once
+SUMMARY_SECTION_CHUNKS = int(os.getenv("summary_section_chunks", 24)) ##average chunks per section, about 6k tokens
+SUMMARY_REDUCE_MAX_TOKENS = int(os.getenv("summary_reduce_max_tokens", 24_000)) ##partial summaries reduced in one prompt
+SUMMARY_CACHE_TTL_SECONDS = float(os.getenv("summary_cache_ttl_seconds", 30 * 24 * 3600)) ##cached partial summaries older than this are summarised again
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv("summary_cache_max_entries", 50_000)) ##the oldest partial summaries go past this many rows
+
+
+def iter_sections(text_blocks: Iterable[str], section_chunks: int = SUMMARY_SECTION_CHUNKS)->Iterator[tuple[str, str]]:
+    '''
+    group the chunks of the text into sections and yield (section hash, section text),
+    a section ends on a chunk whose hash is a multiple of section_chunks (between half and twice the average size)
+    so an edit only moves the boundaries of the sections around it and the other sections keep their hash
+    '''
+    chunk_hashes = []
+    chunks = []
+    for chunk in iter_chunks(text_blocks):
+        chunk_hash = hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+        chunk_hashes.append(chunk_hash)
+        chunks.append(chunk)
+        boundary = int(chunk_hash[:8], 16) % section_chunks == 0
+        if (boundary and len(chunks) >= section_chunks // 2) or len(chunks) >= section_chunks * 2:
+            yield hashlib.sha256("".join(chunk_hashes).encode("utf-8")).hexdigest(), "\n".join(chunks)
+            chunk_hashes = []
+            chunks = []
+    if chunks:
+        yield hashlib.sha256("".join(chunk_hashes).encode("utf-8")).hexdigest(), "\n".join(chunks)
+
+async def get_section_summary(section_hash: str)->str | None:
+    '''the cached partial summary of the section, None for a miss or an expired row'''
+    async with AsyncSessionLocal() as db:
+        section_summary = await db.get(SectionSummary, section_hash)
+        if section_summary is None or section_summary.created_at <= datetime.now() - timedelta(seconds=SUMMARY_CACHE_TTL_SECONDS):
+            return None
+        return section_summary.summary
+
+async def save_section_summary(section_hash: str, summary: str):
+    '''
+    cache the partial summary, expired rows are deleted on the way and the oldest go once the table holds more than SUMMARY_CACHE_MAX_ENTRIES,
+    sections are shared by every blob containing them so the rows are not tied to a blob's lifetime
+    '''
+    now = datetime.now()
+    async with AsyncSessionLocal() as db:
+        await db.merge(SectionSummary(section_hash=section_hash, summary=summary, created_at=now))
+        await db.execute(delete(SectionSummary).where(SectionSummary.created_at <= now - timedelta(seconds=SUMMARY_CACHE_TTL_SECONDS)))
+        ##a save follows an llm call, so counting the rows each time costs nothing noticeable
+        overflow = (await db.execute(select(func.count()).select_from(SectionSummary))).scalar_one() - SUMMARY_CACHE_MAX_ENTRIES
+        if overflow > 0:
+            ##a little more than needed so eviction does not run on every save
+            oldest = select(SectionSummary.section_hash).order_by(SectionSummary.created_at.asc()).limit(overflow + max(1, SUMMARY_CACHE_MAX_ENTRIES // 100))
+            await db.execute(delete(SectionSummary).where(SectionSummary.section_hash.in_(oldest)))
+        await db.commit()
+
+async def summarize_section(client: AsyncOpenAI, section_hash: str, section: str)->str:
+    '''map step, the partial summary is cached by the section hash'''
+    cached_summary = await get_section_summary(section_hash=section_hash)
+    if cached_summary is not None:
+        return cached_summary
+    response = await client.chat.completions.create(
+        model="deepseek-chat",
+        messages=[
+            {"role": "system", "content": "You are a best literature writer, please complete the following task"},
+            {"role": "user", "content": f'''
+                This is one section of a longer file. Please summarize the key points of this section in a short paragraph.
+                Please give me the direct summary NO OTHERS
+                This is the section:
+                {section}
+            '''}
+        ],
+        stream=False
+    )
+    summary = response.choices[0].message.content
+    await save_section_summary(section_hash=section_hash, summary=summary)
+    return summary
+
+async def reduce_summaries(client: AsyncOpenAI, summaries: list[str], semaphore: asyncio.Semaphore)->str:
+    '''
+    reduce step, partial summaries which do not fit in one prompt are reduced group by group first
+    '''
+    groups = [[]]
+    group_tokens = 0
+    for summary in summaries:
+        summary_tokens = cached_token_counts(summary)
+        if groups[-1] and group_tokens + summary_tokens > SUMMARY_REDUCE_MAX_TOKENS:
+            groups.append([])
+            group_tokens = 0
+        groups[-1].append(summary)
+        group_tokens += summary_tokens
+    if len(groups) > 1:
+        async def reduce_group(group: list[str])->str:
+            async with semaphore:
+                return await summarize_section(
+                    client=client,
+                    section_hash=hashlib.sha256("\x00".join(group).encode("utf-8")).hexdigest(),
+                    section="\n\n".join(group)
+                )
+        return await reduce_summaries(client=client, summaries=await asyncio.gather(*[reduce_group(group) for group in groups]), semaphore=semaphore)
+    section_summaries = "\n\n".join(groups[0])
+    response = await client.chat.completions.create(
+        model="deepseek-chat",
+        messages=[
+            {"role": "system", "content": "You are a best literature writer, please complete the following task"},
+            {"role": "user", "content": f'''
+                Plase create a summary of the content of the file in 1 or 2 sentences and make sure the summary will be good enough and NOT too long.
+                Please give me the direct summary and the purpose of the document NO OTHERS
+                These are the summaries of the sections of the file in order:
+                {section_summaries}
+            '''}
+        ],
+        stream=False
+    )
+    return response.choices[0].message.content
+
+async def generate_file_summary(text_blocks: Iterable[str], concurrency: int = SUMMARY_CONCURRENCY)->str:
+    '''
+    map-reduce summary of a file streamed in text blocks: sections are summarized concurrently
+    (at most `concurrency` requests and section texts in flight), then the partial summaries are reduced to the final one
+    '''
+    client = AsyncOpenAI(api_key=os.getenv("api_key"), base_url="https://api.deepseek.com")
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def map_section(section_hash: str, section: str)->str:
+        try:
+            return await summarize_section(client=client, section_hash=section_hash, section=section)
+        finally:
+            semaphore.release()
+
+    tasks = []
+    try:
+        sections = iter_sections(text_blocks)
+        while True:
+            ##wait for a free slot before reading the next section, so only `concurrency` sections are held
+            await semaphore.acquire()
+            ##reading, splitting and hashing the next section runs in a worker thread
+            next_section = await asyncio.to_thread(next, sections, None)
+            if next_section is None:
+                semaphore.release()
+                break
+            section_hash, section = next_section
+            tasks.append(asyncio.create_task(map_section(section_hash=section_hash, section=section)))
+        partial_summaries = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return await reduce_summaries(client=client, summaries=list(partial_summaries), semaphore=semaphore)
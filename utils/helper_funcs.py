@@ -1,9 +1,11 @@
 import os
+import uuid
+import shutil
+import hashlib
 import aiofiles
-from fastapi import File
+from fastapi import UploadFile
 from model.file_parser import Chromadb_agent
 from sqlalchemy.ext.asyncio import AsyncSession
-from openai import AsyncOpenAI
 from model.sqlite import SummaryIndex, AsyncSessionLocal
 from sqlalchemy import delete, and_, select
 from datetime import datetime
@@ -12,134 +14,327 @@ import docker
 import time
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
-from utils.file_content_extractor import file_content_extract
+from utils.file_content_extractor import iter_file_content
+from utils.file_summarizer import generate_file_summary
 from typing import Type
 from pydantic import BaseModel
 from langchain_openai import ChatOpenAI
-from utils.token_counter import get_token_counts
+from utils.token_counter import estimate_tokens, rough_exceeds, exceeds, count_tokens
 from model.file_upload_models import UploadedFile
-from model.session_manager import manager
+from model.ingestion_jobs import ingestion_manager, IngestionJob, ProgressReporter, IngestionCancelledError
+from model.dependency.dependencies import get_chromadb_agent_singleton
+from model.content_store import content_store
+from model.collection_registry import collection_registry
 import asyncio
 from model.code_app_models import Code
+from dotenv import load_dotenv
 
+load_dotenv()
 
-async def generate_file_summary(file_content: str )->str:
-    client = AsyncOpenAI(api_key=os.getenv("api_key"), base_url="https://api.deepseek.com")
-    response = await client.chat.completions.create(
-        model="deepseek-chat",
-        messages=[
-            {"role": "system", "content": "You are a best literature writer, please complete the following task"},
-            {"role": "user", "content": f'''
-                Plase create a summary of the content of the file in 1 or 2 sentences and make sure the summary will be good enough and NOT too long.
-                Please give me the direct summary and the purpose of the document NO OTHERS
-                This is the content of the file:
-                {file_content}
-            '''}
-        ],
-        stream=False
-    )
-    return response.choices[0].message.content
+UPLOAD_CHUNK_SIZE = int(os.getenv("upload_chunk_size", 1024 * 1024)) ##bytes read from the upload per iteration
+MAX_UPLOAD_FILE_SIZE = int(os.getenv("max_upload_file_size", 200 * 1024 * 1024)) ##per file limit in bytes
+MAX_CONCURRENT_UPLOADS = int(os.getenv("max_concurrent_uploads", 4)) ##per request limit on files processed at once
+INGESTION_STAGING_DIR = os.getenv("ingestion_staging_dir", "ingestion_staging") ##one copy per upload which its ingestion job extracts from
+
+
+class UploadTooLargeError(Exception):
+    '''raised when an upload crosses MAX_UPLOAD_FILE_SIZE'''
+
+
+async def stream_upload_to_disk(
+        file: UploadFile,
+        file_path: Path,
+        max_size: int = MAX_UPLOAD_FILE_SIZE,
+        chunk_size: int = UPLOAD_CHUNK_SIZE
+    )->tuple[int, str]:
+    '''
+    stream the upload into file_path in fixed-size chunks and hash the bytes as they arrive,
+    bytes go to a .part file first so a rejected upload never replaces an existing file
+    return (number of bytes written, sha256 hex digest)
+    '''
+    ##reject early when the client has declared the size
+    if file.size is not None and file.size > max_size:
+        raise UploadTooLargeError(f"{file.filename} is {file.size} bytes, limit is {max_size} bytes")
+    sha256 = hashlib.sha256()
+    total_size = 0
+    partial_path = file_path.with_name(f"{file_path.name}.part")
+    try:
+        async with aiofiles.open(partial_path, "wb") as buffer:
+            while chunk := await file.read(chunk_size):
+                total_size += len(chunk)
+                ##check the limit before the chunk reaches disk
+                if total_size > max_size:
+                    raise UploadTooLargeError(f"{file.filename} exceeds the limit of {max_size} bytes")
+                sha256.update(chunk)
+                await buffer.write(chunk)
+        os.replace(partial_path, file_path)
+    except BaseException:
+        if partial_path.exists():
+            os.remove(partial_path)
+        raise
+    return (total_size, sha256.hexdigest())
 
-async def file_upload_revert_handler(file: File, session_id: str, chromadb_client: Chromadb_agent, db: AsyncSession):
+async def file_upload_revert_handler(file_name: str, session_id: str, chromadb_client: Chromadb_agent, db: AsyncSession):
     ##remove residual file
-    # if os.path.exists(f"uploads/{session_id}/{file.filename}"):
-    #     os.remove(f"uploads/{session_id}/{file.filename}")
+    # if os.path.exists(f"uploads/{session_id}/{file_name}"):
+    #     os.remove(f"uploads/{session_id}/{file_name}")
 
     ##remove residual summary index
     delete_statement = delete(SummaryIndex).where(
         and_(
             SummaryIndex.session_id == session_id,
-            SummaryIndex.file_name == file.filename
+            SummaryIndex.file_name == file_name
         )
     )
     await db.execute(delete_statement)
     await db.commit()
 
     ##remove chromadb collection
-    chromadb_client.remove_collection_by_filename(session_id=session_id, filename=file.filename)
+    chromadb_client.remove_collection_by_filename(session_id=session_id, filename=file_name)
+    await collection_registry.remove_file(session_id=session_id, file_name=file_name)
+
+    ##the session's file no longer points at a blob, the content of a blob no other session uses is freed
+    for each in await content_store.release_file(session_id=session_id, file_name=file_name):
+        chromadb_client.remove_collection(collection_name=each)
+
+
+def replace_with_copy(source: Path, target: Path):
+    '''copy source over target, a reader of target sees either the old or the new file'''
+    partial_path = target.with_name(f"{target.name}.{uuid.uuid4().hex[:8]}.part")
+    try:
+        shutil.copyfile(source, partial_path)
+        os.replace(partial_path, target)
+    except BaseException:
+        if partial_path.exists():
+            os.remove(partial_path)
+        raise
 
+def staging_dir(session_id: str)->Path:
+    return Path(INGESTION_STAGING_DIR, session_id)
 
-async def file_upload_handler(file: File, session_id: str, chromadb_client: Chromadb_agent)->UploadedFile:
+async def file_upload_handler(file: UploadFile, session_id: str)->tuple[UploadedFile, Path | None]:
+    '''
+    stream the upload into a staged copy of its own and then into coding_space/{session_id},
+    the ingestion job extracts from the staged copy, so a later upload under the same name cannot change the bytes behind its hash,
+    return (uploaded file, staged copy for the ingestion job, None when the upload was rejected)
+    '''
     file_path = Path((f"coding_space/{session_id}/{file.filename}"))
-    MAX_INDEX_THRESHOLD = 320_000
+    ##the suffix picks the extractor
+    staged_path = staging_dir(session_id) / f"{uuid.uuid4().hex}{Path(file.filename).suffix}"
     os.makedirs(file_path.parent, exist_ok=True)
+    os.makedirs(staged_path.parent, exist_ok=True)
     try:
-        ##save the file into the directory
-        async with aiofiles.open(file_path, "wb") as buffer:
-            content = await file.read()
-            await buffer.write(content)
-
-        ##content extract
-        file_content_result = await file_content_extract(file_path=file_path)
-        if file_content_result[0]:
-            num_tokens = await asyncio.to_thread(get_token_counts, file_content_result[1])
-            if num_tokens > MAX_INDEX_THRESHOLD:
-                ##indexing the uploads
-                await chromadb_client.index_file(session_id=session_id,  filename=file.filename, text=file_content_result[1])
-                ##generate summary and save it into sqlite
-                summary = await generate_file_summary(file_content=file_content_result[1])
-
-                ##each corutines must use a different db session
-                async with AsyncSessionLocal() as db:
-                    ##upsert ops the summary index record
-                    result = await db.execute(
-                        select(SummaryIndex).where(
-                            and_(
-                                SummaryIndex.session_id == session_id,
-                                SummaryIndex.file_name == file.filename
+        file_size, file_hash = await stream_upload_to_disk(file=file, file_path=staged_path)
+        await asyncio.to_thread(replace_with_copy, staged_path, file_path)
+        return UploadedFile(
+            file_name=file.filename,
+            estimated_tokens=0,
+            process_method="coding",
+            result=False,
+            file_hash=file_hash,
+            file_size=file_size
+        ), staged_path
+    except UploadTooLargeError as e:
+        return UploadedFile(
+            file_name=file.filename,
+            estimated_tokens=0,
+            process_method="coding",
+            result=False,
+            error=str(e)
+        ), None
+    except BaseException:
+        if staged_path.exists():
+            os.remove(staged_path)
+        raise
+
+
+async def summary_index_upsert(session_id: str, file_name: str, summary: str):
+    ##each corutines must use a different db session
+    async with AsyncSessionLocal() as db:
+        ##upsert ops the summary index record
+        result = await db.execute(
+            select(SummaryIndex).where(
+                and_(
+                    SummaryIndex.session_id == session_id,
+                    SummaryIndex.file_name == file_name
+                )
+            )
+        )
+        existing_summary = result.scalar_one_or_none()
+        if existing_summary:
+            existing_summary.summary = summary
+            existing_summary.updated_at = datetime.now()
+        else:
+            new_summary = SummaryIndex(
+                session_id=session_id,
+                file_name=file_name,
+                summary=summary,
+                updated_at=datetime.now()
+            )
+            db.add(new_summary)
+        await db.commit()
+
+
+async def file_ingestion_handler(job: IngestionJob, report_progress: ProgressReporter)->UploadedFile:
+    '''
+    ingestion pipeline run by the ingestion workers: extract -> count -> index -> summarize,
+    the artifacts are stored once per content hash and a repeat upload only links the session to them,
+    the text is extracted from the job's staged copy of the upload which is removed once the job is done
+    '''
+    file_path = Path(job.file_path)
+    MAX_INDEX_THRESHOLD = 320_000
+    chromadb_client = get_chromadb_agent_singleton()
+    collection_name = Chromadb_agent.content_collection_name(file_hash=job.file_hash)
+    ##a previous version uploaded under the same name lets indexing reuse its unchanged chunks
+    previous_blob = await content_store.resolve(session_id=job.session_id, file_name=job.file_name)
+    base_collection_name = previous_blob.collection_name if previous_blob and previous_blob.file_hash != job.file_hash else None
+    try:
+        async with content_store.lock(job.file_hash):
+            blob = await content_store.get_blob(file_hash=job.file_hash)
+            if blob is None: ##first time these bytes are seen
+                ##content extract, pages are streamed to the content store while the token estimate is summed
+                await report_progress(job, "extracting", 0.1)
+                estimated_tokens = 0
+
+                async def estimated_pages():
+                    nonlocal estimated_tokens
+                    async for page in iter_file_content(file_path=file_path):
+                        estimated_tokens += estimate_tokens(page)
+                        yield page
+
+                try:
+                    await content_store.write_text(file_hash=job.file_hash, text_blocks=estimated_pages())
+                except Exception as e:
+                    content_store.discard_text(file_hash=job.file_hash)
+                    print(f"content extraction of {job.file_name} failed: {e}")
+                    return UploadedFile(
+                        file_name=job.file_name,
+                        estimated_tokens=0,
+                        process_method="coding",
+                        result=False,
+                        file_hash=job.file_hash,
+                        file_size=job.file_size
+                    )
+                try:
+                    await report_progress(job, "counting", 0.3)
+                    ##the estimate routes a file far from the threshold,
+                    ##otherwise the stored text is encoded only until the count crosses the threshold
+                    needs_index = rough_exceeds(estimated_tokens, MAX_INDEX_THRESHOLD)
+                    if needs_index is None:
+                        needs_index = await asyncio.to_thread(exceeds, content_store.iter_text(file_hash=job.file_hash), MAX_INDEX_THRESHOLD)
+                    if needs_index:
+                        ##the token count reported for an indexed file is exact, counted while the file is indexed
+                        counting = asyncio.create_task(asyncio.to_thread(count_tokens, content_store.iter_text(file_hash=job.file_hash)))
+                        ##indexing the uploads, the stored text is read back in blocks and chunked as a stream
+                        try:
+                            await report_progress(job, "indexing", 0.4)
+                            job.index_result = await chromadb_client.index_file(
+                                session_id=job.session_id,
+                                filename=job.file_name,
+                                text_blocks=content_store.iter_text(file_hash=job.file_hash),
+                                file_hash=job.file_hash,
+                                collection_name=collection_name,
+                                base_collection_name=base_collection_name
                             )
+                        except BaseException:
+                            counting.cancel()
+                            raise
+                        num_tokens = await counting
+                        ##generate summary
+                        await report_progress(job, "summarizing", 0.8)
+                        summary = await generate_file_summary(text_blocks=content_store.iter_text(file_hash=job.file_hash))
+                        blob = await content_store.save_blob(
+                            file_hash=job.file_hash,
+                            num_tokens=num_tokens,
+                            process_method="file_search",
+                            collection_name=collection_name,
+                            summary=summary
                         )
-                    )
-                    existing_summary = result.scalar_one_or_none()
-                    if existing_summary:
-                        existing_summary.summary = summary
-                        existing_summary.updated_at = datetime.now()
                     else:
-                        new_summary = SummaryIndex(
-                            session_id=session_id,
-                            file_name=file.filename,
-                            summary=summary,
-                            updated_at=datetime.now()
+                        ##the count of a coding file is never reported, the estimate is kept
+                        blob = await content_store.save_blob(
+                            file_hash=job.file_hash,
+                            num_tokens=estimated_tokens,
+                            process_method="coding"
                         )
-                        db.add(new_summary)
-                    await db.commit()
-                return UploadedFile(
-                    file_name=file.filename, 
-                    estimated_tokens=num_tokens, 
-                    process_method="file_search", 
-                    result=True
-                )
+                except Exception:
+                    ##still under the hash lock, so the file is not one a waiting repeat upload has written
+                    content_store.discard_text(file_hash=job.file_hash)
+                    raise
+            ##link the session to the stored artifacts
+            released_collections = await content_store.link(session_id=job.session_id, file_name=job.file_name, file_hash=job.file_hash)
+        ##an older version of the file uploaded under the same name is no longer used by any session
+        for each in released_collections:
+            chromadb_client.remove_collection(collection_name=each)
+
+        if blob.process_method == "file_search":
+            ##register the collection the session's file is searched in, a repeat upload reuses the registered chunk count
+            await collection_registry.register(
+                session_id=job.session_id,
+                file_name=job.file_name,
+                collection_name=blob.collection_name,
+                file_hash=job.file_hash,
+                chunk_count=job.index_result["total_chunks"] if job.index_result else None
+            )
+            ##save the summary into sqlite
+            await summary_index_upsert(session_id=job.session_id, file_name=job.file_name, summary=blob.summary)
+            uploaded_file = UploadedFile(
+                file_name=job.file_name,
+                estimated_tokens=blob.num_tokens,
+                process_method="file_search",
+                result=True,
+                file_hash=job.file_hash,
+                file_size=job.file_size
+            )
+        else:
+            ##a file re-uploaded under the same name may no longer be indexed
+            await collection_registry.remove_file(session_id=job.session_id, file_name=job.file_name)
+            uploaded_file = UploadedFile(
+                file_name=job.file_name,
+                estimated_tokens=0,
+                process_method="coding",
+                result=False,
+                file_hash=job.file_hash,
+                file_size=job.file_size
+            )
+        ##the session was deleted while the job ran, its cleanup may have run before the rows above were written
+        if job.cancelled:
+            raise IngestionCancelledError(f"session {job.session_id} was deleted while {job.file_name} was ingested")
+        return uploaded_file
+    except Exception as e:
+        async with AsyncSessionLocal() as db:
+            await file_upload_revert_handler(file_name=job.file_name, session_id=job.session_id, chromadb_client=chromadb_client, db=db)
+        ##drop a half built content collection, a stored one still belongs to other sessions
+        if await content_store.get_blob(file_hash=job.file_hash) is None:
+            chromadb_client.remove_collection(collection_name=collection_name)
+        ##fall back to the coding app, the error stays visible on the job status
+        job.error = str(e)
         return UploadedFile(
-            file_name=file.filename, 
-            estimated_tokens=0, 
-            process_method="coding", 
-            result=False
+            file_name=job.file_name,
+            estimated_tokens=0,
+            process_method="coding",
+            result=False,
+            file_hash=job.file_hash,
+            file_size=job.file_size
         )
-    except Exception as e:
-            await file_upload_revert_handler(file=file, session_id=session_id, chromadb_client=chromadb_client, db=db)
-            return UploadedFile(
-                file_name=file.filename, 
-                estimated_tokens=0, 
-                process_method="coding", 
-                result=False
-            )
+    finally:
+        if file_path.exists():
+            os.remove(file_path)
 
 def get_uploaded_file_from_session(session_id: str)->str | None:
     '''
-    getting the file upload status from the session, only getting once
+    getting the files whose ingestion has finished for the session, only getting once
     '''
-    session = manager.get_session(thread_id=session_id)
-    if session.get("file_upload", []): ##if there is any existing file upload
+    finished_uploads = ingestion_manager.pop_finished_uploads(session_id=session_id)
+    if finished_uploads: ##if there is any existing file upload
         file_upload_summary = ""
-        for each_file in session.get("file_upload"):
+        for each_file in finished_uploads:
             process_method = "writing code app to process" if each_file.process_method == "coding" else "using file search app to search"
-            file_upload_summary += f"File name: {each_file.file_name}, MUST ROUTE TO: {process_method} agent to process"
-        manager.update_session(thread_id=session_id, updates={**session, "file_upload": []}) ## remove upload record once read
+            file_upload_summary += f"File name: {each_file.file_name}, MUST ROUTE TO: {process_method} agent to process\n"
         return file_upload_summary
     else:
         return None
-    
-    
+
 
 async def summary_fetcher(session_id: str)-> tuple[bool, str | None]:
     async with AsyncSessionLocal() as db:
@@ -0,0 +1,48 @@
+import numpy as np
+from typing import Sequence
+
+RRF_K = 60 ##rank offset of reciprocal rank fusion
+
+
+def reciprocal_rank_fusion(
+        ranked_ids: Sequence[Sequence[int]],
+        weights: Sequence[float] | None = None,
+        k: int = RRF_K
+    )->tuple[np.ndarray, np.ndarray]:
+    '''
+    weighted reciprocal rank fusion of any number of ranked chunk id lists (best first),
+    a chunk scores sum(weight / (k + rank)) over every list it appears in, repeated hits in one list all count
+    return (chunk ids, fused scores) sorted by score, ties keep the smaller chunk id first
+    '''
+    weights = weights if weights is not None else [1.0] * len(ranked_ids)
+    if len(weights) != len(ranked_ids):
+        raise ValueError(f"{len(weights)} weights given for {len(ranked_ids)} rankings")
+    id_arrays = [np.asarray(each, dtype=np.int64) for each in ranked_ids]
+    if not any(len(each) for each in id_arrays):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    all_ids = np.concatenate(id_arrays)
+    contributions = np.concatenate([
+        weight / (k + np.arange(len(each), dtype=np.float64))
+        for weight, each in zip(weights, id_arrays)
+    ])
+    unique_ids, inverse = np.unique(all_ids, return_inverse=True)
+    scores = np.bincount(inverse, weights=contributions, minlength=len(unique_ids))
+    ##unique_ids is ascending so a stable sort keeps ties in chunk order
+    order = np.argsort(-scores, kind="stable")
+    return unique_ids[order], scores[order]
+
+def top_k_by_token_budget(
+        chunk_ids: np.ndarray,
+        token_counts: np.ndarray,
+        token_budget: int,
+        min_chunks: int = 1
+    )->np.ndarray:
+    '''
+    the best ranked chunk ids whose token counts add up to at most token_budget,
+    at least min_chunks are kept even when the first ones alone go over the budget
+    '''
+    if len(chunk_ids) == 0:
+        return chunk_ids
+    cumulative_tokens = np.cumsum(np.asarray(token_counts, dtype=np.int64))
+    keep = int(np.searchsorted(cumulative_tokens, token_budget, side="right"))
+    return chunk_ids[: max(keep, min(min_chunks, len(chunk_ids)))]
@@ -0,0 +1,32 @@
+from typing import Iterable, Iterator
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+SEPARATORS = ["\n\n", "\n", ". ", " ", ""]
+
+
+def build_text_splitter(chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP)->RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=len, separators=SEPARATORS)
+
+def iter_chunks(text_blocks: Iterable[str], chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP)->Iterator[str]:
+    '''
+    split a stream of text blocks (pages, file reads) into chunks without joining the whole text,
+    the last chunk of every split is carried into the next block with the raw text it came from,
+    so the overlap between consecutive chunks is kept across block boundaries
+    '''
+    text_spliter = build_text_splitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    buffer = ""
+    for block in text_blocks:
+        buffer += block
+        if len(buffer) <= chunk_size:
+            continue
+        chunks = text_spliter.split_text(buffer)
+        if len(chunks) < 2:
+            continue
+        yield from chunks[:-1]
+        ##carry the raw tail (with its whitespace) rather than the stripped chunk
+        carry_start = buffer.rfind(chunks[-1])
+        buffer = buffer[carry_start:] if carry_start >= 0 else chunks[-1]
+    if buffer:
+        yield from text_spliter.split_text(buffer)
@@ -1,9 +1,99 @@
+import math
+from functools import lru_cache
 import tiktoken
+from typing import Iterable, Iterator
+
+ENCODING_NAME = "cl100k_base"
+CHARS_PER_TOKEN = 4.0 ##rough ratio for english text with cl100k_base
+ESTIMATE_MARGIN = 2.0 ##rough_exceeds only decides when the estimate is this far from the threshold
+ENCODE_SLICE_CHARS = 64_000
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+##loaded once per process, get_encoding rebuilds the encoder lookups on every call otherwise
+encoder = tiktoken.get_encoding(ENCODING_NAME)
+
 
 def get_token_counts(content: str)->int:
     '''
     count the number of token given by the content
     '''
-    enc = tiktoken.get_encoding("cl100k_base")
-    token_count = len(enc.encode(content))
-    return token_count
\ No newline at end of file
+    return len(encoder.encode(content, disallowed_special=()))
+
+@lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+def cached_token_counts(content: str)->int:
+    '''
+    get_token_counts memoised by content, for passages which are counted again across search rounds
+    '''
+    return get_token_counts(content)
+
+def truncate_to_tokens(text: str, max_tokens: int)->tuple[str, int]:
+    '''
+    (the text cut to at most max_tokens tokens, its token count), text within the cap is only counted (memoised)
+    '''
+    if max_tokens <= 0:
+        return "", 0
+    token_count = cached_token_counts(text)
+    if token_count <= max_tokens:
+        return text, token_count
+    token_ids = encoder.encode(text, disallowed_special=())[:max_tokens]
+    ##the cut can split the bytes of a character, the partial character is dropped instead of becoming U+FFFD
+    return encoder.decode(token_ids, errors="ignore"), len(token_ids)
+
+def text_slices(text: str, slice_chars: int = ENCODE_SLICE_CHARS)->Iterator[str]:
+    '''
+    cut the text on whitespace so no token is split between two slices
+    '''
+    start = 0
+    while start < len(text):
+        end = min(start + slice_chars, len(text))
+        if end < len(text):
+            cut = text.rfind(" ", start, end)
+            if cut > start:
+                end = cut
+        yield text[start:end]
+        start = end
+
+def exceeds(text: str | Iterable[str], threshold: int, slice_chars: int = ENCODE_SLICE_CHARS)->bool:
+    '''
+    encode the text (or a stream of text blocks) slice by slice and stop as soon as the token count crosses the threshold
+    '''
+    if isinstance(text, str):
+        if len(text) * 4 <= threshold: ##a token covers at least one utf-8 byte, a char is at most 4 bytes
+            return False
+        text = [text]
+    token_count = 0
+    for block in text:
+        for text_slice in text_slices(block, slice_chars=slice_chars):
+            token_count += len(encoder.encode(text_slice, disallowed_special=()))
+            if token_count > threshold:
+                return True
+    return False
+
+def count_tokens(text_blocks: Iterable[str], slice_chars: int = ENCODE_SLICE_CHARS)->int:
+    '''
+    exact token count of a stream of text blocks, encoded slice by slice so the whole text is never held
+    '''
+    return sum(
+        len(encoder.encode(text_slice, disallowed_special=()))
+        for block in text_blocks
+        for text_slice in text_slices(block, slice_chars=slice_chars)
+    )
+
+def estimate_tokens(text: str)->int:
+    '''
+    cheap estimate from the char and utf-8 byte lengths without encoding,
+    multi-byte chars (e.g. CJK) are close to one token each, the rest follows CHARS_PER_TOKEN
+    '''
+    char_count = len(text)
+    multibyte_chars = min(char_count, (len(text.encode("utf-8", errors="ignore")) - char_count) // 2)
+    return math.ceil((char_count - multibyte_chars) / CHARS_PER_TOKEN) + multibyte_chars
+
+def rough_exceeds(estimated_tokens: int, threshold: int, margin: float = ESTIMATE_MARGIN)->bool | None:
+    '''
+    route on the estimate (see estimate_tokens) alone, None when it is too close to the threshold to decide
+    '''
+    if estimated_tokens * margin < threshold:
+        return False
+    if estimated_tokens > threshold * margin:
+        return True
+    return None